@@ -0,0 +1,457 @@
+import pika
+import json
+import random
+import threading
+import time
+from pika.exceptions import AMQPError
+from spill_journal import SpillJournal
+from config import (
+    RABBITMQ_CONFIG, AMQP_HEARTBEAT, AMQP_RECONNECT_ATTEMPTS,
+    AMQP_RECONNECT_BASE_DELAY, AMQP_RECONNECT_MAX_DELAY, AMQP_BLOCKED_TIMEOUT,
+    SPILL_JOURNAL_DIR, SPILL_JOURNAL_SIZE, SPILL_JOURNAL_SLOTS, SPILL_JOURNAL_SYNC
+)
+
+
+# Real-time sales and bulk resync traffic use separate queues
+LANES = ('realtime', 'bulk')
+
+
+def jump_consistent_hash(key, buckets):
+    """
+    Map an integer key to one of `buckets` buckets (Lamping and Veach jump hash).
+    Changing the bucket count only moves about 1/buckets of the keys.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def get_bindings(branch_name, lane='realtime'):
+    """
+    Get the (queue name, routing key) pairs of a branch lane
+    The realtime lane keeps the original names, other lanes add a suffix.
+    There is one pair per shard when sharding is enabled.
+    """
+    queue_name = RABBITMQ_CONFIG['queues'][f'{branch_name}_queue']
+    routing_key = branch_name
+    
+    if lane != 'realtime':
+        queue_name = f'{queue_name}.{lane}'
+        routing_key = f'{branch_name}.{lane}'
+    
+    shards = RABBITMQ_CONFIG['shards']
+    if not shards:
+        return [(queue_name, routing_key)]
+    return [(f'{queue_name}.shard.{shard}', f'{routing_key}.{shard}') for shard in range(shards)]
+
+
+def get_queue_names(branch_name, lane='realtime'):
+    """Get the queue names of a branch lane, one per shard when sharding is enabled"""
+    return [queue_name for queue_name, routing_key in get_bindings(branch_name, lane)]
+
+
+def get_routing_key(branch_name, sale_id, lane='realtime'):
+    """
+    Get the routing key for a sale
+    All messages for one sale_id land on the same shard, which keeps them in order.
+    """
+    routing_key = branch_name if lane == 'realtime' else f'{branch_name}.{lane}'
+    shards = RABBITMQ_CONFIG['shards']
+    
+    if not shards:
+        return routing_key
+    return f'{routing_key}.{jump_consistent_hash(sale_id, shards)}'
+
+
+def declare_branch_topology(channel, branch_name):
+    """
+    Declare the exchange, queues and bindings used by a branch
+    :param channel: Open channel
+    :param branch_name: 'branch1' or 'branch2'
+    :return: Dictionary of lane to the lane's queue names
+    """
+    channel.exchange_declare(
+        exchange=RABBITMQ_CONFIG['exchange'],
+        exchange_type=RABBITMQ_CONFIG['exchange_type'],
+        durable=True
+    )
+    
+    queue_names = {}
+    for lane in LANES:
+        queue_names[lane] = []
+        
+        for queue_name, routing_key in get_bindings(branch_name, lane):
+            channel.queue_declare(
+                queue=queue_name,
+                durable=True
+            )
+            
+            channel.queue_bind(
+                exchange=RABBITMQ_CONFIG['exchange'],
+                queue=queue_name,
+                routing_key=routing_key
+            )
+            
+            queue_names[lane].append(queue_name)
+    
+    return queue_names
+
+
+class AMQPConnectionManager:
+    """
+    Process-wide pool of long-lived RabbitMQ connections for producers.
+    pika's BlockingConnection is not thread-safe, so every thread gets its own
+    warm connection and confirm-enabled channel, reused across publishes.
+    While RabbitMQ blocks publishing (memory or disk alarm), messages are spilled
+    to a local journal and drained in order once the broker accepts them again.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+    
+    def __init__(self):
+        self.local = threading.local()
+        self.connections = []
+        self.declared_branches = set()
+        self.lock = threading.Lock()
+        self.journal = None
+        self.journal_opened = False
+    
+    @classmethod
+    def get_instance(cls):
+        """Get the process-wide connection manager"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+    
+    def get_parameters(self):
+        """Build connection parameters from the RabbitMQ configuration"""
+        credentials = pika.PlainCredentials(
+            RABBITMQ_CONFIG['username'],
+            RABBITMQ_CONFIG['password']
+        )
+        
+        return pika.ConnectionParameters(
+            host=RABBITMQ_CONFIG['host'],
+            port=RABBITMQ_CONFIG['port'],
+            credentials=credentials,
+            heartbeat=AMQP_HEARTBEAT,
+            blocked_connection_timeout=AMQP_BLOCKED_TIMEOUT
+        )
+    
+    def get_channel(self):
+        """Get the calling thread's warm channel, reconnecting if needed"""
+        connection = getattr(self.local, 'connection', None)
+        channel = getattr(self.local, 'channel', None)
+        
+        if connection and connection.is_open and channel and channel.is_open:
+            self.keepalive()
+            if self.local.connection:
+                return self.local.channel
+        
+        return self.reconnect(lost=connection is not None)
+    
+    def keepalive(self, poll=False):
+        """
+        Service heartbeats on the calling thread's connection if it has been idle
+        :param poll: Process pending I/O even if the connection was used recently
+        """
+        connection = getattr(self.local, 'connection', None)
+        if not connection or not connection.is_open:
+            return
+        
+        # Blocking connections only send heartbeats and run the blocked/unblocked
+        # callbacks while processing I/O. A blocked connection is polled every time
+        # so the unblock is noticed quickly.
+        idle = time.monotonic() - self.local.last_activity
+        if not poll and idle < AMQP_HEARTBEAT / 4 and not getattr(self.local, 'blocked', False):
+            return
+        
+        try:
+            connection.process_data_events(time_limit=0)
+            self.touch()
+        except AMQPError as e:
+            print(f"RabbitMQ connection lost during keepalive: {e}")
+            self.close()
+    
+    def touch(self):
+        """Record activity on the calling thread's connection"""
+        self.local.last_activity = time.monotonic()
+    
+    def reconnect(self, lost=False):
+        """
+        Open a new connection for the calling thread with jittered exponential backoff
+        :param lost: True if a previous connection was lost
+        """
+        self.close()
+        
+        # The broker may have been reset, declare the topology again
+        if lost:
+            with self.lock:
+                self.declared_branches.clear()
+        
+        for attempt in range(AMQP_RECONNECT_ATTEMPTS):
+            try:
+                connection = pika.BlockingConnection(self.get_parameters())
+                connection.add_on_connection_blocked_callback(self.on_blocked)
+                connection.add_on_connection_unblocked_callback(self.on_unblocked)
+                channel = connection.channel()
+                
+                # Enable publisher confirms so a successful publish means the broker has the message
+                channel.confirm_delivery()
+                
+                self.local.connection = connection
+                self.local.channel = channel
+                self.touch()
+                
+                with self.lock:
+                    self.connections.append(connection)
+                
+                print(f"Opened RabbitMQ connection for {threading.current_thread().name}")
+                return channel
+                
+            except AMQPError as e:
+                delay = min(AMQP_RECONNECT_MAX_DELAY, AMQP_RECONNECT_BASE_DELAY * (2 ** attempt))
+                delay = random.uniform(0, delay)
+                print(f"Error connecting to RabbitMQ (attempt {attempt + 1}): {e}, retrying in {delay:.2f}s")
+                time.sleep(delay)
+        
+        print("Giving up connecting to RabbitMQ")
+        return None
+    
+    def declare_branch_topology(self, branch_name):
+        """
+        Declare a branch's topology once per process
+        :param branch_name: 'branch1' or 'branch2'
+        """
+        with self.lock:
+            if branch_name in self.declared_branches:
+                return True
+        
+        channel = self.get_channel()
+        if not channel:
+            return False
+        
+        try:
+            declare_branch_topology(channel, branch_name)
+        except AMQPError as e:
+            print(f"Error declaring topology for {branch_name}: {e}")
+            self.close()
+            return False
+        
+        with self.lock:
+            self.declared_branches.add(branch_name)
+        
+        print(f"Declared RabbitMQ topology for '{branch_name}'")
+        return True
+    
+    def on_blocked(self, connection, method_frame):
+        """Called on the connection's thread when RabbitMQ blocks publishing"""
+        self.local.blocked = True
+        print(f"RabbitMQ blocked publishing ({method_frame.method.reason}), spilling to the local journal")
+    
+    def on_unblocked(self, connection, method_frame):
+        """Called on the connection's thread when RabbitMQ accepts publishes again"""
+        self.local.blocked = False
+        print("RabbitMQ unblocked publishing")
+    
+    def is_blocked(self):
+        """Check whether the calling thread must not publish to RabbitMQ right now"""
+        # After a publish stalled until the blocked timeout, wait before trying again
+        if time.monotonic() < getattr(self.local, 'blocked_until', 0):
+            return True
+        
+        if not getattr(self.local, 'blocked', False):
+            return False
+        
+        # Pick up a pending connection.unblocked
+        self.keepalive()
+        return getattr(self.local, 'blocked', False)
+    
+    def get_journal(self):
+        """Open this process's spill journal on first use"""
+        with self.lock:
+            if not self.journal_opened:
+                self.journal_opened = True
+                try:
+                    self.journal = SpillJournal.open_slot(
+                        SPILL_JOURNAL_DIR, 'amqp', SPILL_JOURNAL_SIZE,
+                        SPILL_JOURNAL_SLOTS, SPILL_JOURNAL_SYNC
+                    )
+                except OSError as e:
+                    print(f"Error opening the spill journal: {e}")
+                
+                if self.journal is None:
+                    print("No spill journal available, publishes fail while RabbitMQ is blocked")
+            
+            return self.journal
+    
+    def spill(self, exchange, routing_key, body, properties):
+        """
+        Append a message to the spill journal
+        :return: False if there is no journal or it is full
+        """
+        journal = self.get_journal()
+        if journal is None:
+            return False
+        
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        
+        record = json.dumps({
+            'exchange': exchange,
+            'routing_key': routing_key,
+            'body': body,
+            'delivery_mode': properties.delivery_mode if properties else None,
+            'content_type': properties.content_type if properties else None,
+            'headers': properties.headers if properties else None
+        })
+        
+        if not journal.append(record.encode('utf-8')):
+            print(f"Spill journal {journal.path} is full")
+            return False
+        
+        return True
+    
+    def drain_journal(self):
+        """
+        Publish spilled messages in order on the calling thread's channel
+        :return: True once the journal is empty
+        """
+        journal = self.get_journal()
+        if journal is None or not journal.count:
+            return True
+        
+        if self.is_blocked():
+            return False
+        
+        def publish_record(record):
+            try:
+                message = json.loads(record)
+            except ValueError as e:
+                # A corrupt record would stop the journal from ever draining
+                print(f"Dropping unreadable spilled message: {e}")
+                return True
+            
+            return self._publish(
+                message['exchange'],
+                message['routing_key'],
+                message['body'],
+                pika.BasicProperties(
+                    delivery_mode=message['delivery_mode'],
+                    content_type=message['content_type'],
+                    headers=message['headers']
+                )
+            )
+        
+        drained = journal.drain(publish_record)
+        if drained:
+            print(f"Drained {drained} spilled messages to RabbitMQ, {journal.count} left")
+        
+        return not journal.count
+    
+    def publish(self, exchange, routing_key, body, properties):
+        """
+        Publish a message on the calling thread's warm channel.
+        While RabbitMQ is blocked, or older messages are still spilled, the message is
+        appended to the spill journal instead so that ordering is kept.
+        :return: True if the broker confirmed the message or it was spilled
+        """
+        if self.is_blocked() or not self.drain_journal():
+            return self.spill(exchange, routing_key, body, properties)
+        
+        if self._publish(exchange, routing_key, body, properties):
+            return True
+        
+        # The connection was blocked before the publish, or the publish stalled on it
+        if self.is_blocked():
+            return self.spill(exchange, routing_key, body, properties)
+        
+        return False
+    
+    def _publish(self, exchange, routing_key, body, properties):
+        """
+        Publish directly to RabbitMQ.
+        The publish is retried once on a fresh connection if the current one was lost.
+        """
+        for attempt in range(2):
+            channel = self.get_channel()
+            if not channel:
+                return False
+            
+            # Let a pending connection.blocked switch publishing to the journal
+            # before basic_publish stalls until the blocked timeout
+            self.keepalive(poll=True)
+            if getattr(self.local, 'blocked', False):
+                return False
+            
+            channel = self.local.channel
+            if not channel:
+                continue
+            
+            try:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties
+                )
+                self.touch()
+                return True
+            except pika.exceptions.ConnectionBlockedTimeout as e:
+                print(f"Publish stalled on a blocked connection: {e}")
+                self.close()
+                self.local.blocked_until = time.monotonic() + AMQP_BLOCKED_TIMEOUT
+                return False
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                print(f"Publish failed on a stale connection: {e}")
+                self.close()
+        
+        return False
+    
+    def close(self):
+        """Close the calling thread's connection"""
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        self.local.channel = None
+        self.local.blocked = False
+        
+        if connection is None:
+            return
+        
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        
+        try:
+            if connection.is_open:
+                connection.close()
+        except AMQPError:
+            pass
+    
+    def close_all(self):
+        """Close every connection opened by this manager"""
+        with self.lock:
+            connections = list(self.connections)
+            self.connections.clear()
+            self.declared_branches.clear()
+        
+        for connection in connections:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except AMQPError:
+                pass
+        
+        with self.lock:
+            journal = self.journal
+            self.journal = None
+            self.journal_opened = False
+        
+        if journal is not None:
+            journal.close()
+        
+        print("Closed all RabbitMQ producer connections")
@@ -0,0 +1,108 @@
+import csv
+import os
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from sale_record import SaleRecord, MAX_QTY, MAX_REGION_LENGTH, MAX_PRODUCT_LENGTH, check_money, check_text
+from config import BULK_INSERT_CHUNK_SIZE
+
+REQUIRED_COLUMNS = ['date', 'region', 'product', 'qty', 'cost', 'amt', 'tax', 'total']
+
+
+class BulkImportError(ValueError):
+    """Raised when a sales file cannot be read"""
+
+
+def parse_sale_row(row, line_number):
+    """
+    Convert a file row (dictionary of column values) into a SaleRecord.
+    Values must fit the product_sales columns, so a row the database would
+    reject is found before anything is imported.
+    :param line_number: Row position, used in error messages
+    """
+    try:
+        sale_date = row['date']
+        if isinstance(sale_date, datetime):
+            sale_date = sale_date.date()
+        elif not isinstance(sale_date, date):
+            sale_date = date.fromisoformat(str(sale_date)[:10])
+        
+        qty = int(row['qty'])
+        if abs(qty) > MAX_QTY:
+            raise ValueError(f"qty {qty} does not fit INT")
+        
+        return SaleRecord(
+            None,
+            sale_date,
+            check_text(str(row['region']), 'region', MAX_REGION_LENGTH),
+            check_text(str(row['product']), 'product', MAX_PRODUCT_LENGTH),
+            qty,
+            check_money(Decimal(str(row['cost'])), 'cost'),
+            check_money(Decimal(str(row['amt'])), 'amt'),
+            check_money(Decimal(str(row['tax'])), 'tax'),
+            check_money(Decimal(str(row['total'])), 'total')
+        )
+    except (KeyError, ValueError, InvalidOperation) as e:
+        raise BulkImportError(f"Invalid sale on row {line_number}: {e}")
+
+
+def read_csv_sales(path, chunk_size):
+    """Read a CSV file with a header row in chunks of SaleRecords"""
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.DictReader(csv_file)
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise BulkImportError(f"Missing columns: {', '.join(missing)}")
+        
+        chunk = []
+        for line_number, row in enumerate(reader, start=2):
+            chunk.append(parse_sale_row(row, line_number))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        
+        if chunk:
+            yield chunk
+
+
+def read_parquet_sales(path, chunk_size):
+    """Read a Parquet file in chunks of SaleRecords (needs pandas with pyarrow)"""
+    try:
+        import pandas as pd
+        frame = pd.read_parquet(path, columns=REQUIRED_COLUMNS)
+    except ImportError as e:
+        raise BulkImportError(f"Parquet support requires pyarrow: {e}")
+    except (KeyError, ValueError) as e:
+        raise BulkImportError(f"Cannot read {path}: {e}")
+    
+    for start in range(0, len(frame), chunk_size):
+        rows = frame.iloc[start:start + chunk_size].to_dict('records')
+        yield [parse_sale_row(row, start + offset + 1) for offset, row in enumerate(rows)]
+
+
+def read_sales_file(path, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    """
+    Read a CSV or Parquet sales file
+    :param path: File path, the format is picked from the extension
+    :return: Iterator of SaleRecord lists of at most chunk_size rows
+    """
+    extension = os.path.splitext(path)[1].lower()
+    
+    if extension == '.csv':
+        return read_csv_sales(path, chunk_size)
+    if extension in ('.parquet', '.pq'):
+        return read_parquet_sales(path, chunk_size)
+    
+    raise BulkImportError(f"Unsupported file type: {extension or path}")
+
+
+def validate_sales_file(path, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    """
+    Parse a whole sales file without importing it, so a bad row is reported
+    before anything is written to the database
+    :return: Number of valid rows
+    :raises BulkImportError: On the first unreadable row
+    """
+    count = 0
+    for chunk in read_sales_file(path, chunk_size):
+        count += len(chunk)
+    return count
@@ -1,3 +1,5 @@
+import os
+
 # Database configuration
 DB_CONFIG = {
     'head_office': {
@@ -34,8 +36,67 @@ RABBITMQ_CONFIG = {
     'queues': {
         'branch1_queue': 'branch1',
         'branch2_queue': 'branch2'
-    }
+    },
+    # Number of shard queues per branch (0 disables sharding).
+    # Sales are spread over the shards by consistent hashing of sale_id.
+    'shards': 0
 }
 
 # Sync interval in seconds
-SYNC_INTERVAL = 60  # 1 minute
\ No newline at end of file
+SYNC_INTERVAL = 60  # 1 minute, starting interval of each branch
+SYNC_MIN_INTERVAL = 5  # Shortest interval while a branch is busy
+SYNC_MAX_INTERVAL = 600  # Longest interval while a branch is idle
+
+# Outbox relay settings
+OUTBOX_BATCH_SIZE = 500  # Outbox entries published per batch
+OUTBOX_POLL_INTERVAL = 1  # Seconds between outbox polls when idle
+
+# Shared AMQP connection settings for producers
+AMQP_HEARTBEAT = 60  # Heartbeat timeout negotiated with RabbitMQ, in seconds
+AMQP_RECONNECT_ATTEMPTS = 5  # Connection attempts before giving up
+AMQP_RECONNECT_BASE_DELAY = 0.5  # First backoff delay in seconds
+AMQP_RECONNECT_MAX_DELAY = 10  # Backoff delay cap in seconds
+AMQP_BLOCKED_TIMEOUT = 30  # Seconds a publish may stall on a blocked connection before it is spilled
+
+# Local spill journal for publishes made while the broker is blocked
+SPILL_JOURNAL_DIR = 'spill'
+SPILL_JOURNAL_SIZE = 64 * 1024 * 1024  # Bytes per journal file, publishes fail once it is full
+SPILL_JOURNAL_SLOTS = 8  # Journal files, one per producer process on the host
+SPILL_JOURNAL_SYNC = False  # Flush every spilled message to disk (survives host crashes, slower)
+
+# Consumer dedup index settings
+DEDUP_MAX_SALE_ID = 8_000_000  # Highest sale_id tracked per branch (1 bit each, ~1 MB)
+DEDUP_REPORT_EVERY = 1000  # Log the dedup hit rate every N lookups
+
+# Content-hash reconciliation settings
+RECONCILE_LEAF_SIZE = 256  # sale_id range compared row by row
+RECONCILE_FANOUT = 16  # Sub-ranges per range when descending the digest tree
+RECONCILE_FETCH_SIZE = 500  # Rows fetched per query when re-sending upserts
+
+# Sharded consumer settings
+SHARD_CLAIM_INTERVAL = 30  # Seconds between claim rounds (claim unowned shards, release extras)
+SHARD_CLAIM_LIMIT = 0  # Hard cap on shards owned by one consumer, on top of the fair share (0 = fair share only)
+SHARD_MEMBERS_QUEUE = 'sales.consumers'  # Queue whose consumer count is the number of live consumers
+
+# Bulk import settings
+BULK_INSERT_CHUNK_SIZE = 5000  # Rows per multi-row INSERT (and per transaction)
+
+# Live dashboard settings
+LIVE_REFRESH_INTERVAL = 2  # Seconds between dashboard polls of the shared live feed
+BRANCH_SNAPSHOT_TTL = 10  # Seconds a branch table snapshot is shared between clients
+HEAD_OFFICE_RELOAD_INTERVAL = 30  # Seconds between head office reloads, picks up commits made by other consumer processes
+
+# Priority lanes: unacknowledged messages allowed per lane, shared by the lane's
+# queues. A real-time sale waits behind at most LANE_PREFETCH['bulk'] bulk messages,
+# or that many per claimed bulk shard when sharded (each shard has its own channel).
+LANE_PREFETCH = {
+    'realtime': 10,
+    'bulk': 1
+}
+
+# Pipeline profiling: 'off', 'timing' or 'sampling' (can be switched at runtime)
+PROFILE_MODE = os.environ.get('SALES_PROFILING', 'off')
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples in sampling mode
+PROFILE_MAX_SAMPLES = 10000  # Durations kept per stage for the percentile report
+PROFILE_MAX_TRACES = 10000  # Most recent traced stage records written to the traces report
+PROFILE_OUTPUT_DIR = 'profiles'  # Where reports are written
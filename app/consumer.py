@@ -1,17 +1,27 @@
 import pika
-import json
 import threading
-from datetime import datetime
 from db_connector import DatabaseConnector
-from config import RABBITMQ_CONFIG
+from amqp_connection import LANES, declare_branch_topology, get_queue_names
+from dedup_index import SaleDedupIndex
+from sale_decoder import SaleDecoder
+from profiling import PipelineProfiler
+from config import RABBITMQ_CONFIG, SHARD_CLAIM_INTERVAL, SHARD_CLAIM_LIMIT, SHARD_MEMBERS_QUEUE, LANE_PREFETCH
 
 class SalesConsumer:
-    def __init__(self):
-        """Initialize consumer for the head office"""
+    def __init__(self, event_bus=None):
+        """
+        Initialize consumer for the head office
+        :param event_bus: Optional EventBus notified of every committed change
+        """
+        self.event_bus = event_bus
         self.db = DatabaseConnector('head_office')
+        self.dedup = SaleDedupIndex()
+        self.decoder = SaleDecoder()
+        self.profiler = PipelineProfiler.get_instance()
         self.connection = None
         self.channel = None
         self.threads = []
+        self.claimed_shards = {}
         self.is_consuming = False
         
     def connect_to_rabbitmq(self):
@@ -33,39 +43,40 @@ class SalesConsumer:
             self.connection = pika.BlockingConnection(parameters)
             self.channel = self.connection.channel()
             
-            # Declare exchange
-            self.channel.exchange_declare(
-                exchange=RABBITMQ_CONFIG['exchange'],
-                exchange_type=RABBITMQ_CONFIG['exchange_type'],
-                durable=True
-            )
-            
             # Set up consumers for both branch queues
+            lane_queues = {lane: [] for lane in LANES}
             for branch in ['branch1', 'branch2']:
-                queue_name = RABBITMQ_CONFIG['queues'][f'{branch}_queue']
-                
-                # Declare queue
-                self.channel.queue_declare(
-                    queue=queue_name,
-                    durable=True
-                )
-                
-                # Bind queue to exchange
-                self.channel.queue_bind(
-                    exchange=RABBITMQ_CONFIG['exchange'],
-                    queue=queue_name,
-                    routing_key=branch
-                )
-                
-                # Set QoS (quality of service)
-                self.channel.basic_qos(prefetch_count=1)
-                
-                # Set up consumer with correct callback signature
+                # Declare exchange, queues and bindings
+                queue_names = declare_branch_topology(self.channel, branch)
+                for lane in LANES:
+                    lane_queues[lane].extend(queue_names[lane])
+            
+            # One channel per lane so each lane gets its own prefetch window,
+            # shared by the consumers of every branch queue in the lane
+            if not RABBITMQ_CONFIG['shards']:
+                for lane in LANES:
+                    channel = self.connection.channel()
+                    channel.basic_qos(prefetch_count=LANE_PREFETCH[lane], global_qos=True)
+                    
+                    for queue_name in lane_queues[lane]:
+                        channel.basic_consume(
+                            queue=queue_name,
+                            on_message_callback=self.process_message,
+                            auto_ack=False
+                        )
+            
+            # Sharded queues are claimed dynamically
+            if RABBITMQ_CONFIG['shards']:
+                # Consuming the members queue makes this consumer count towards the fair share
+                self.channel.queue_declare(queue=SHARD_MEMBERS_QUEUE, auto_delete=True)
                 self.channel.basic_consume(
-                    queue=queue_name,
-                    on_message_callback=self.process_message,
-                    auto_ack=False
+                    queue=SHARD_MEMBERS_QUEUE,
+                    on_message_callback=lambda ch, method, properties, body: None,
+                    auto_ack=True
                 )
+                
+                self.claimed_shards = {}
+                self.claim_shards()
             
             print("Connected to RabbitMQ and ready to consume messages")
             return True
@@ -74,71 +85,171 @@ class SalesConsumer:
             print(f"Error connecting to RabbitMQ: {e}")
             return False
     
+    def get_shard_share(self):
+        """
+        Get the number of shards this consumer should own: all shard queues split
+        evenly over the consumers registered on the members queue
+        """
+        consumers = self.channel.queue_declare(queue=SHARD_MEMBERS_QUEUE, passive=True).method.consumer_count
+        total = RABBITMQ_CONFIG['shards'] * len(LANES) * len(['branch1', 'branch2'])
+        share = -(-total // max(consumers, 1))
+        
+        if SHARD_CLAIM_LIMIT:
+            share = min(share, SHARD_CLAIM_LIMIT)
+        return share
+    
+    def claim_shards(self):
+        """
+        Claim shard queues that no other consumer owns, up to this consumer's fair share.
+        Each shard is consumed exclusively, so a shard has a single active consumer
+        and keeps its messages in order. A consumer above its share (e.g. after more
+        consumers started) releases its most recently claimed shards, and released
+        or orphaned shards are picked up on the next claim round.
+        """
+        # Forget shards whose channel was closed
+        for queue_name, channel in list(self.claimed_shards.items()):
+            if not channel.is_open:
+                del self.claimed_shards[queue_name]
+        
+        share = self.get_shard_share()
+        
+        # Closing the channel requeues its unacknowledged messages for the next owner
+        while len(self.claimed_shards) > share:
+            queue_name, channel = self.claimed_shards.popitem()
+            channel.close()
+            print(f"Released shard {queue_name}")
+        
+        # Real-time shards are claimed first
+        for lane in LANES:
+            for branch in ['branch1', 'branch2']:
+                for queue_name in get_queue_names(branch, lane):
+                    if queue_name in self.claimed_shards:
+                        continue
+                    
+                    if len(self.claimed_shards) >= share:
+                        return
+                    
+                    # One channel per shard, the broker closes it if the shard is taken
+                    channel = self.connection.channel()
+                    channel.basic_qos(prefetch_count=LANE_PREFETCH[lane])
+                    
+                    try:
+                        channel.basic_consume(
+                            queue=queue_name,
+                            on_message_callback=self.process_message,
+                            auto_ack=False,
+                            exclusive=True
+                        )
+                    except pika.exceptions.ChannelClosedByBroker:
+                        continue
+                    
+                    self.claimed_shards[queue_name] = channel
+                    print(f"Claimed shard {queue_name}")
+    
+    def schedule_shard_claims(self):
+        """Periodically try to claim unowned shards from the consuming thread"""
+        def claim_round():
+            if not self.is_consuming:
+                return
+            try:
+                self.claim_shards()
+            except Exception as e:
+                print(f"Error claiming shards: {e}")
+            self.connection.call_later(SHARD_CLAIM_INTERVAL, claim_round)
+        
+        self.connection.call_later(SHARD_CLAIM_INTERVAL, claim_round)
+    
     def close_connection(self):
         """Close RabbitMQ connection"""
         self.is_consuming = False
-        if self.connection and self.connection.is_open:
-            self.connection.close()
-            print("RabbitMQ connection closed")
             
-        # Wait for threads to complete
+        # Wait for threads to complete, the consuming thread closes its connection
         for thread in self.threads:
             if thread.is_alive():
                 thread.join()
+        
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+            print("RabbitMQ connection closed")
     
     def process_message(self, ch, method, properties, body):
         """
-        Process incoming messages from RabbitMQ
+        Process incoming messages from RabbitMQ, timed under the producer's
+        trace id while profiling
+        """
+        if not self.profiler.timing:
+            return self.handle_message(ch, method, properties, body)
+        
+        headers = properties.headers or {}
+        self.profiler.record_transit(headers)
+        
+        with self.profiler.trace(headers.get('trace_id')), self.profiler.stage('consume'):
+            return self.handle_message(ch, method, properties, body)
+    
+    def handle_message(self, ch, method, properties, body):
+        """
+        Decode a message and apply it to the head office
         :param ch: Channel
         :param method: Method
         :param properties: Properties
         :param body: Message body
         """
         try:
-            # Parse message
-            message = json.loads(body)
-            print(f"Received message: {message}")
+            # Decode and validate message
+            with self.profiler.stage('decode'):
+                decoded = self.decoder.decode(body)
+            print(f"Received {decoded.event} of sale {decoded.sale_id} from {decoded.branch}")
+            
+            source_branch = decoded.branch
+            event = decoded.event
+            sale = decoded.sale
+            
+            # Known duplicates are acknowledged without touching the database
+            with self.profiler.stage('dedup'):
+                known = event == 'insert' and self.dedup.contains(source_branch, decoded.sale_id)
+            
+            if known:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                print(f"Sale {decoded.sale_id} from {source_branch} already synced, skipping")
+                return
             
             # Connect to database
-            self.db.connect()
-            
-            # Convert date string to date object if needed
-            if isinstance(message['date'], str):
-                try:
-                    message['date'] = datetime.fromisoformat(message['date']).date()
-                except ValueError:
-                    # Handle ISO 8601 format with Z
-                    if message['date'].endswith('Z'):
-                        message['date'] = datetime.fromisoformat(message['date'][:-1]).date()
-                    else:
-                        # Try with different format
-                        message['date'] = datetime.strptime(message['date'], "%Y-%m-%d").date()
-            
-            # Create sale data for head office
-            sale_data = {
-                'sale_id': message['sale_id'],  # Make sure to include sale_id
-                'date': message['date'],
-                'region': message['region'],
-                'product': message['product'],
-                'qty': message['qty'],
-                'cost': message['cost'],
-                'amt': message['amt'],
-                'tax': message['tax'],
-                'total': message['total']
-            }
-            
-            # Add to head office database
-            source_branch = message['branch']
-            success = self.db.add_sale_to_head_office(sale_data, source_branch)
+            with self.profiler.stage('head_office.connect'):
+                self.db.connect()
+            
+            if event == 'delete':
+                with self.profiler.stage('head_office.write'):
+                    success = self.db.delete_sale_from_head_office(decoded.sale_id, source_branch)
+                if success:
+                    self.dedup.discard(source_branch, decoded.sale_id)
+                    self.publish_commit_event(decoded)
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    print(f"Processed delete of sale {decoded.sale_id} from {source_branch}")
+                else:
+                    ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                    print(f"Failed to process delete, requeueing: {decoded}")
+                
+                self.db.disconnect()
+                return
+            
+            # Add to head office database, corrections overwrite the existing copy
+            with self.profiler.stage('head_office.write'):
+                if event == 'upsert':
+                    success = self.db.upsert_sale_to_head_office(sale, source_branch)
+                else:
+                    success = self.db.add_sale_to_head_office(sale, source_branch)
             
             if success:
+                self.dedup.add(source_branch, sale.sale_id)
+                self.publish_commit_event(decoded)
+                
                 # Acknowledge message
                 ch.basic_ack(delivery_tag=method.delivery_tag)
-                print(f"Processed sale from {message['branch']}, Product: {message['product']}, Region: {message['region']}")
+                print(f"Processed sale from {source_branch}, Product: {sale.product}, Region: {sale.region}")
             else:
                 # Reject message and requeue
                 ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-                print(f"Failed to process sale, requeueing: {message}")
+                print(f"Failed to process sale, requeueing: {sale}")
             
             # Disconnect from database
             self.db.disconnect()
@@ -148,23 +259,60 @@ class SalesConsumer:
             # Reject message but don't requeue if it's a parsing error
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
     
+    def publish_commit_event(self, decoded):
+        """Tell in-process listeners (e.g. the live dashboard) about a committed change"""
+        if self.event_bus:
+            self.event_bus.publish('head_office.committed', {
+                'event': decoded.event,
+                'branch': decoded.branch,
+                'sale_id': decoded.sale_id,
+                'sale': decoded.sale
+            })
+    
+    def warm_dedup_in_background(self):
+        """
+        Warm the dedup index from the sales already in the head office without
+        delaying startup. Until it is warm, lookups miss and fall back to the database.
+        """
+        def warm_thread():
+            # Own connection, the consuming thread uses self.db
+            db = DatabaseConnector('head_office')
+            if db.connect():
+                self.dedup.warm(db)
+                db.disconnect()
+        
+        thread = threading.Thread(target=warm_thread)
+        thread.daemon = True
+        thread.start()
+    
     def start_consuming(self):
         """Start consuming messages in a separate thread"""
+        self.warm_dedup_in_background()
+        
         if not self.connect_to_rabbitmq():
             print("Failed to connect to RabbitMQ")
             return False
         
         def consume_thread():
-            self.is_consuming = True
             try:
                 print("Started consuming messages")
-                self.channel.start_consuming()
+                
+                if RABBITMQ_CONFIG['shards']:
+                    self.schedule_shard_claims()
+                
+                # Dispatch deliveries for all channels until asked to stop
+                while self.is_consuming:
+                    self.connection.process_data_events(time_limit=1)
             except Exception as e:
                 print(f"Consuming stopped: {e}")
             finally:
                 self.is_consuming = False
+                if self.connection and self.connection.is_open:
+                    self.connection.close()
                 print("Stopped consuming messages")
         
+        self.is_consuming = True
+        
         # Start consuming in a separate thread
         thread = threading.Thread(target=consume_thread)
         thread.daemon = True
@@ -175,9 +323,6 @@ class SalesConsumer:
     
     def stop_consuming(self):
         """Stop consuming messages"""
-        if self.channel and self.is_consuming:
-            self.channel.stop_consuming()
-            self.is_consuming = False
-            
+        # The consuming thread notices within a second and closes its connection
         self.close_connection()
-        print("Stopped consuming messages")
\ No newline at end of file
+        print(f"Stopped consuming messages, dedup index: {self.dedup.get_stats()}")
\ No newline at end of file
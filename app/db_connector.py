@@ -1,6 +1,7 @@
 import mysql.connector
 from mysql.connector import Error
 from config import DB_CONFIG
+from sale_record import SaleRecord
 
 class DatabaseConnector:
     def __init__(self, db_type):
@@ -65,8 +66,38 @@ class DatabaseConnector:
                 self.connection.rollback()
             return None
     
-    def get_all_sales_for_sync(self):
-        """Get all sales records from branch for syncing to head office"""
+    def fetch_rows(self, query, params=None):
+        """
+        Execute a SELECT and return plain tuples instead of dictionaries
+        Used on the sync hot path, where rows are turned straight into SaleRecords.
+        """
+        try:
+            if not self.connection or not self.connection.is_connected():
+                if not self.connect():
+                    print(f"Failed to connect to {self.db_type} database")
+                    return None
+            
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(query, params or ())
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+            
+        except Error as e:
+            print(f"Error executing query in {self.db_type}: {e}")
+            print(f"Query: {query}")
+            print(f"Params: {params}")
+            if self.connection and self.connection.is_connected():
+                self.connection.rollback()
+            return None
+    
+    def get_all_sales_for_sync(self, after_sale_id=None):
+        """
+        Get all sales records from branch for syncing to head office
+        :param after_sale_id: Only return sales with a higher sale_id (primary key range scan)
+        :return: List of SaleRecord
+        """
         if self.db_type in ['branch1', 'branch2']:
             query = """
             SELECT 
@@ -74,32 +105,66 @@ class DatabaseConnector:
             FROM 
                 product_sales 
             """
+            params = None
+            
+            if after_sale_id is not None:
+                query += "WHERE sale_id > %s ORDER BY sale_id"
+                params = (after_sale_id,)
             
             # Get records
-            records = self.execute_query(query)
-            return records
+            rows = self.fetch_rows(query, params)
+            if rows is None:
+                return None
+            return [SaleRecord.from_row(row) for row in rows]
         else:
             print("This method is only for branch databases")
             return []
     
-    def check_for_unsynced_sales(self):
+    def check_for_unsynced_sales(self, head_office_high_water_mark):
         """
-        Check if there are sales in the branch that might not be synced to head office
+        Count the sales in the branch that are not yet synced to head office
+        MAX(sale_id) is read from the primary key, so an up-to-date branch costs a
+        single index lookup; otherwise only the pending range is counted.
+        :param head_office_high_water_mark: Highest original_sale_id applied by the head office
+        :return: Number of pending sales, or None on error
         """
         if self.db_type in ['branch1', 'branch2']:
+            max_sale_id = self.get_max_sale_id()
+            
+            if max_sale_id is None or max_sale_id <= head_office_high_water_mark:
+                return 0
+            
             query = """
             SELECT COUNT(*) as count
             FROM product_sales
+            WHERE sale_id > %s
             """
             
-            result = self.execute_query(query)
-            return result[0]['count'] > 0 if result else False
+            result = self.execute_query(query, (head_office_high_water_mark,))
+            return result[0]['count'] if result else None
         else:
             print("This method is only for branch databases")
-            return False
+            return None
+    
+    def get_last_update_time(self):
+        """
+        Get the time InnoDB last modified product_sales (a cheap row-version signal)
+        This also changes on updates and deletes, which the high-water mark cannot see.
+        """
+        # Read live statistics instead of the cached information_schema values
+        self.execute_query("SET SESSION information_schema_stats_expiry = 0", commit=True)
+        
+        query = """
+        SELECT UPDATE_TIME AS update_time
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'product_sales'
+        """
+        
+        result = self.execute_query(query, (self.config['database'],))
+        return result[0]['update_time'] if result else None
             
-    def add_sale_to_head_office(self, sale_data, source_branch):
-        """Add a new sale record to the head office database."""
+    def add_sale_to_head_office(self, sale, source_branch):
+        """Add a new sale record (SaleRecord) to the head office database."""
         if self.db_type == 'head_office':
             try:
                 # First check if this sale_id from this branch already exists
@@ -109,15 +174,15 @@ class DatabaseConnector:
                 WHERE original_sale_id = %s AND source_branch = %s
                 """
 
-                check_result = self.execute_query(check_query, (sale_data['sale_id'], source_branch))
+                check_result = self.execute_query(check_query, (sale.sale_id, source_branch))
 
                 # If record already exists, skip insertion
                 if check_result and check_result[0]['count'] > 0:
-                    print(f"Sale {sale_data['sale_id']} from {source_branch} already exists in head office.")
+                    print(f"Sale {sale.sale_id} from {source_branch} already exists in head office.")
                     return True
 
                 # Debugging
-                print(f"Inserting sale: {sale_data}")
+                print(f"Inserting sale: {sale}")
 
                 insert_query = """
                 INSERT INTO product_sales 
@@ -125,25 +190,14 @@ class DatabaseConnector:
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """
 
-                params = (
-                    sale_data['sale_id'],  # Store original sale_id
-                    source_branch,
-                    sale_data['date'],
-                    sale_data['region'],
-                    sale_data['product'],
-                    sale_data['qty'],
-                    sale_data['cost'],
-                    sale_data['amt'],
-                    sale_data['tax'],
-                    sale_data['total']
-                )
+                params = sale.to_head_office_params(source_branch)
 
                 result = self.execute_query(insert_query, params, commit=True)
                 if result:
-                    print(f"Successfully added sale {sale_data['sale_id']} from {source_branch} to head office")
+                    print(f"Successfully added sale {sale.sale_id} from {source_branch} to head office")
                     return True
                 else:
-                    print(f"Failed to add sale {sale_data['sale_id']} from {source_branch} to head office")
+                    print(f"Failed to add sale {sale.sale_id} from {source_branch} to head office")
                     return False
 
             except Exception as e:
@@ -153,6 +207,162 @@ class DatabaseConnector:
             print("This method is only for head office database")
             return False
     
+    def _sale_key_scope(self, source_branch=None):
+        """
+        Get the id column and extra filter identifying a branch's sales
+        :param source_branch: Required for the head office, ignored for branches
+        """
+        if self.db_type == 'head_office':
+            return 'original_sale_id', 'AND source_branch = %s', (source_branch,)
+        return 'sale_id', '', ()
+    
+    def _row_hash_expression(self, id_column):
+        """SQL expression hashing a sale's content, identical on branches and head office"""
+        return f"MD5(CONCAT_WS('|', {id_column}, date, region, product, qty, cost, amt, tax, total))"
+    
+    def get_max_sale_id(self, source_branch=None):
+        """
+        Get the highest sale_id stored for a branch
+        :param source_branch: Branch name, required for the head office
+        :return: Highest sale_id, 0 if there are no sales, or None on error
+        """
+        id_column, branch_filter, branch_params = self._sale_key_scope(source_branch)
+        query = f"""
+        SELECT MAX({id_column}) AS max_id
+        FROM product_sales
+        WHERE 1 = 1 {branch_filter}
+        """
+        
+        result = self.execute_query(query, branch_params)
+        if not result:
+            return None
+        return result[0]['max_id'] or 0
+    
+    def get_range_digests(self, low, high, block_size, source_branch=None):
+        """
+        Get a (row count, XOR of row hashes) digest for each sale_id block in a range
+        :param low: First sale_id of the range
+        :param high: Last sale_id of the range
+        :param block_size: Number of sale ids per block
+        :param source_branch: Branch name, required for the head office
+        :return: Dictionary of block number to (count, digest)
+        """
+        id_column, branch_filter, branch_params = self._sale_key_scope(source_branch)
+        row_hash = self._row_hash_expression(id_column)
+        query = f"""
+        SELECT 
+            {id_column} DIV %s AS block,
+            COUNT(*) AS row_count,
+            BIT_XOR(CAST(CONV(LEFT({row_hash}, 16), 16, 10) AS UNSIGNED)) AS digest
+        FROM 
+            product_sales
+        WHERE 
+            {id_column} BETWEEN %s AND %s {branch_filter}
+        GROUP BY 
+            block
+        """
+        
+        result = self.execute_query(query, (block_size, low, high) + branch_params)
+        if result is None:
+            return None
+        return {row['block']: (row['row_count'], int(row['digest'])) for row in result}
+    
+    def get_row_hashes(self, low, high, source_branch=None):
+        """
+        Get the content hash of every sale in a sale_id range
+        :param source_branch: Branch name, required for the head office
+        :return: Dictionary of sale_id to hash
+        """
+        id_column, branch_filter, branch_params = self._sale_key_scope(source_branch)
+        row_hash = self._row_hash_expression(id_column)
+        query = f"""
+        SELECT {id_column} AS sale_id, {row_hash} AS row_hash
+        FROM product_sales
+        WHERE {id_column} BETWEEN %s AND %s {branch_filter}
+        """
+        
+        result = self.execute_query(query, (low, high) + branch_params)
+        if result is None:
+            return None
+        return {row['sale_id']: row['row_hash'] for row in result}
+    
+    def get_sales_by_ids(self, sale_ids):
+        """Get branch sales records (SaleRecord) by sale_id"""
+        if self.db_type in ['branch1', 'branch2']:
+            if not sale_ids:
+                return []
+            
+            placeholders = ', '.join(['%s'] * len(sale_ids))
+            query = f"""
+            SELECT 
+                sale_id, date, region, product, qty, cost, amt, tax, total
+            FROM 
+                product_sales 
+            WHERE 
+                sale_id IN ({placeholders})
+            """
+            rows = self.fetch_rows(query, tuple(sale_ids))
+            if rows is None:
+                return None
+            return [SaleRecord.from_row(row) for row in rows]
+        else:
+            print("This method is only for branch databases")
+            return []
+    
+    def get_synced_sale_keys(self):
+        """Get the (source_branch, original_sale_id) keys stored in the head office"""
+        if self.db_type == 'head_office':
+            query = "SELECT source_branch, original_sale_id FROM product_sales"
+            return self.execute_query(query)
+        else:
+            print("This method is only for head office database")
+            return []
+    
+    def upsert_sale_to_head_office(self, sale, source_branch):
+        """Insert a sale into the head office, or overwrite it if it already exists"""
+        if self.db_type == 'head_office':
+            upsert_query = """
+            INSERT INTO product_sales 
+            (original_sale_id, source_branch, date, region, product, qty, cost, amt, tax, total) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE 
+                date = VALUES(date), region = VALUES(region), product = VALUES(product), 
+                qty = VALUES(qty), cost = VALUES(cost), amt = VALUES(amt), 
+                tax = VALUES(tax), total = VALUES(total)
+            """
+            
+            params = sale.to_head_office_params(source_branch)
+            
+            result = self.execute_query(upsert_query, params, commit=True)
+            if result:
+                print(f"Upserted sale {sale.sale_id} from {source_branch} in head office")
+                return True
+            
+            print(f"Failed to upsert sale {sale.sale_id} from {source_branch} in head office")
+            return False
+        else:
+            print("This method is only for head office database")
+            return False
+    
+    def delete_sale_from_head_office(self, sale_id, source_branch):
+        """Remove a sale that no longer exists in its branch"""
+        if self.db_type == 'head_office':
+            delete_query = """
+            DELETE FROM product_sales
+            WHERE original_sale_id = %s AND source_branch = %s
+            """
+            
+            result = self.execute_query(delete_query, (sale_id, source_branch), commit=True)
+            if result:
+                print(f"Deleted sale {sale_id} from {source_branch} in head office")
+                return True
+            
+            print(f"Failed to delete sale {sale_id} from {source_branch} in head office")
+            return False
+        else:
+            print("This method is only for head office database")
+            return False
+    
     def get_all_sales(self):
         """Get all sales records from a database"""
         query = "SELECT * FROM product_sales"
@@ -163,8 +373,13 @@ class DatabaseConnector:
         query = "SELECT * FROM sales_summary"
         return self.execute_query(query)
             
-    def add_new_sale(self, sale_data):
-        """Add a new sale record to a branch database"""
+    def add_new_sale(self, sale):
+        """
+        Add a new sale record to a branch database
+        :param sale: SaleRecord or sale dictionary, its sale_id is ignored
+        The sale and its outbox entry are written in the same transaction,
+        so every committed sale is eventually published by the outbox relay.
+        """
         if self.db_type in ['branch1', 'branch2']:
             insert_query = """
             INSERT INTO product_sales 
@@ -172,26 +387,172 @@ class DatabaseConnector:
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
             """
             
-            params = (
-                sale_data['date'],
-                sale_data['region'],
-                sale_data['product'],
-                sale_data['qty'],
-                sale_data['cost'],
-                sale_data['amt'],
-                sale_data['tax'],
-                sale_data['total']
-            )
-            
-            self.execute_query(insert_query, params, commit=True)
+            outbox_query = "INSERT INTO sales_outbox (sale_id) VALUES (%s)"
             
-            # Get the sale_id of the newly inserted record
-            get_last_id_query = "SELECT LAST_INSERT_ID() as last_id"
-            result = self.execute_query(get_last_id_query)
+            params = SaleRecord.coerce(sale).to_branch_params()
             
-            if result and 'last_id' in result[0]:
-                return result[0]['last_id']
+            try:
+                if not self.connection or not self.connection.is_connected():
+                    if not self.connect():
+                        print(f"Failed to connect to {self.db_type} database")
+                        return None
+                
+                self.cursor.execute(insert_query, params)
+                
+                # The cursor already knows the generated sale_id, no extra round-trip needed
+                new_sale_id = self.cursor.lastrowid
+                self.cursor.execute(outbox_query, (new_sale_id,))
+                
+                self.connection.commit()
+                print(f"Committed sale {new_sale_id} and its outbox entry to {self.db_type} database")
+                return new_sale_id
+                
+            except Error as e:
+                print(f"Error adding sale in {self.db_type}: {e}")
+                if self.connection and self.connection.is_connected():
+                    self.connection.rollback()
+                return None
+        else:
+            print("This method is only for branch databases")
             return None
+    
+    def bulk_add_sales(self, chunks):
+        """
+        Add many sales to a branch database with chunked multi-row inserts
+        Each chunk is one transaction holding the sales and their outbox entries.
+        :param chunks: Iterable of SaleRecord lists
+        :return: (first_sale_id, last_sale_id, count), first/last are None if nothing was added
+        :raises ValueError, Error: If a later chunk fails, naming the committed sale_id range
+        """
+        if self.db_type not in ['branch1', 'branch2']:
+            print("This method is only for branch databases")
+            return None, None, 0
+        
+        insert_query = """
+        INSERT INTO product_sales 
+        (date, region, product, qty, cost, amt, tax, total) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        
+        # Our rows are all visible in our transaction and lie in [first id, MAX(sale_id)].
+        # Concurrent sales committed in that range get a second outbox entry, which the
+        # idempotent consumer absorbs.
+        outbox_query = """
+        INSERT INTO sales_outbox (sale_id, lane)
+        SELECT sale_id, 'bulk' FROM product_sales WHERE sale_id BETWEEN %s AND %s
+        """
+        
+        first_sale_id = None
+        last_sale_id = None
+        count = 0
+        
+        try:
+            if not self.connection or not self.connection.is_connected():
+                if not self.connect():
+                    print(f"Failed to connect to {self.db_type} database")
+                    return None, None, 0
+            
+            cursor = self.connection.cursor()
+            try:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    
+                    # mysql-connector turns executemany on an INSERT into one multi-row statement
+                    cursor.executemany(insert_query, [sale.to_branch_params() for sale in chunk])
+                    chunk_first_id = cursor.lastrowid
+                    
+                    cursor.execute("SELECT MAX(sale_id) FROM product_sales")
+                    chunk_last_id = cursor.fetchone()[0]
+                    
+                    cursor.execute(outbox_query, (chunk_first_id, chunk_last_id))
+                    self.connection.commit()
+                    
+                    if first_sale_id is None:
+                        first_sale_id = chunk_first_id
+                    last_sale_id = chunk_last_id
+                    count += len(chunk)
+                    print(f"Imported {count} sales into {self.db_type} (up to sale_id {chunk_last_id})")
+            finally:
+                cursor.close()
+            
+        except ValueError as e:
+            # An unreadable row in a later chunk, the earlier chunks are committed
+            if self.connection and self.connection.is_connected():
+                self.connection.rollback()
+            if count:
+                raise type(e)(
+                    f"{e} (sale_id {first_sale_id} to {last_sale_id}, {count} sales, were already imported)"
+                ) from e
+            raise
+        except Error as e:
+            print(f"Error importing sales into {self.db_type}: {e}")
+            if self.connection and self.connection.is_connected():
+                self.connection.rollback()
+            # Returning the committed part would look like a complete import
+            if count:
+                raise type(e)(
+                    f"{e} (sale_id {first_sale_id} to {last_sale_id}, {count} sales, were already imported)"
+                ) from e
+        
+        return first_sale_id, last_sale_id, count
+    
+    def get_outbox_batch(self, limit):
+        """
+        Get the oldest pending outbox entries together with their sale data
+        Real-time entries come before bulk entries, so a large import does not
+        hold back sales entered in the UI.
+        :param limit: Maximum number of entries to return
+        :return: List of (outbox_id, lane, sale_id, SaleRecord) tuples, the record is None
+                 if the sale was deleted before it was published
+        """
+        if self.db_type in ['branch1', 'branch2']:
+            # One query per lane, each a range scan of idx_lane(lane, id) with no sort
+            query = """
+            SELECT 
+                o.id AS outbox_id, o.lane, o.sale_id, s.date, s.region, s.product, 
+                s.qty, s.cost, s.amt, s.tax, s.total
+            FROM 
+                sales_outbox o
+                LEFT JOIN product_sales s ON s.sale_id = o.sale_id
+            WHERE 
+                o.lane = %s
+            ORDER BY 
+                o.id
+            LIMIT %s
+            """
+            
+            rows = self.fetch_rows(query, ('realtime', limit))
+            if rows is not None and len(rows) < limit:
+                bulk_rows = self.fetch_rows(query, ('bulk', limit - len(rows)))
+                rows = None if bulk_rows is None else rows + bulk_rows
+            
+            # End the read transaction so the next poll sees newly committed entries
+            if self.connection and self.connection.is_connected():
+                self.connection.commit()
+            
+            if rows is None:
+                return None
+            return [
+                (row[0], row[1], row[2], SaleRecord.from_row(row[2:]) if row[3] is not None else None)
+                for row in rows
+            ]
+        else:
+            print("This method is only for branch databases")
+            return []
+    
+    def delete_outbox_entries(self, outbox_ids):
+        """
+        Delete outbox entries once their messages have been confirmed by the broker
+        :param outbox_ids: List of outbox entry ids
+        """
+        if self.db_type in ['branch1', 'branch2']:
+            if not outbox_ids:
+                return True
+            
+            placeholders = ', '.join(['%s'] * len(outbox_ids))
+            query = f"DELETE FROM sales_outbox WHERE id IN ({placeholders})"
+            return bool(self.execute_query(query, tuple(outbox_ids), commit=True))
         else:
             print("This method is only for branch databases")
-            return None
\ No newline at end of file
+            return False
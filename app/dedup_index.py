@@ -0,0 +1,124 @@
+import threading
+from config import DEDUP_MAX_SALE_ID, DEDUP_REPORT_EVERY
+
+
+class SaleDedupIndex:
+    """
+    Bounded in-memory index of the sales already stored in the head office,
+    keyed by (source_branch, original_sale_id).
+    Branch sale ids come from AUTO_INCREMENT columns and are dense, so each branch
+    is tracked with a bitmap up to its high-water mark. Ids above DEDUP_MAX_SALE_ID
+    are not tracked and always fall through to the database.
+    """
+    
+    def __init__(self, max_sale_id=DEDUP_MAX_SALE_ID):
+        self.max_sale_id = max_sale_id
+        self.bitmaps = {}
+        self.high_water_marks = {}
+        self.hits = 0
+        self.misses = 0
+        self.discarded_while_warming = None
+        self.lock = threading.Lock()
+    
+    def _bitmap_for(self, branch, sale_id):
+        """Get a branch bitmap large enough to hold sale_id"""
+        bitmap = self.bitmaps.setdefault(branch, bytearray())
+        needed = sale_id // 8 + 1
+        
+        if len(bitmap) < needed:
+            # Grow geometrically to keep resizes rare, without exceeding the bound
+            limit = self.max_sale_id // 8 + 1
+            bitmap.extend(bytes(min(max(needed, len(bitmap) * 2), limit) - len(bitmap)))
+        
+        return bitmap
+    
+    def warm(self, db):
+        """
+        Load the keys already stored in the head office.
+        Safe to run while messages are consumed: the keys are merged into what the
+        consumer recorded meanwhile, and sales deleted during the load stay deleted.
+        :param db: Connected head office DatabaseConnector
+        """
+        with self.lock:
+            self.discarded_while_warming = set()
+        
+        rows = db.get_synced_sale_keys()
+        
+        with self.lock:
+            discarded = self.discarded_while_warming
+            self.discarded_while_warming = None
+            
+            if rows is None:
+                print("Failed to warm the dedup index")
+                return 0
+            
+            for row in rows:
+                key = (row['source_branch'], row['original_sale_id'])
+                if key not in discarded:
+                    self._add(*key)
+        
+        print(f"Warmed dedup index with {len(rows)} sales")
+        return len(rows)
+    
+    def _add(self, branch, sale_id):
+        if sale_id < 0 or sale_id > self.max_sale_id:
+            return
+        
+        bitmap = self._bitmap_for(branch, sale_id)
+        bitmap[sale_id >> 3] |= 1 << (sale_id & 7)
+        
+        if sale_id > self.high_water_marks.get(branch, -1):
+            self.high_water_marks[branch] = sale_id
+    
+    def add(self, branch, sale_id):
+        """Record that a sale is stored in the head office"""
+        with self.lock:
+            self._add(branch, sale_id)
+    
+    def discard(self, branch, sale_id):
+        """Forget a sale, e.g. after it was removed from the head office"""
+        with self.lock:
+            if self.discarded_while_warming is not None:
+                self.discarded_while_warming.add((branch, sale_id))
+            
+            bitmap = self.bitmaps.get(branch)
+            if bitmap is not None and 0 <= sale_id and sale_id >> 3 < len(bitmap):
+                bitmap[sale_id >> 3] &= ~(1 << (sale_id & 7)) & 0xFF
+    
+    def contains(self, branch, sale_id):
+        """
+        Check whether a sale is known to be stored in the head office.
+        A False result means "unknown", the caller must still check the database.
+        """
+        with self.lock:
+            found = False
+            if 0 <= sale_id <= self.high_water_marks.get(branch, -1):
+                bitmap = self.bitmaps[branch]
+                found = bool(bitmap[sale_id >> 3] & (1 << (sale_id & 7)))
+            
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            
+            lookups = self.hits + self.misses
+        
+        if lookups % DEDUP_REPORT_EVERY == 0:
+            print(f"Dedup index: {self.get_stats()}")
+        
+        return found
+    
+    def hit_rate(self):
+        """Share of lookups answered from memory"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+    
+    def get_stats(self):
+        """Get the index size and hit rate"""
+        return {
+            'branches': dict(self.high_water_marks),
+            'memory_bytes': sum(len(bitmap) for bitmap in self.bitmaps.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate(), 4)
+        }
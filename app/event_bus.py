@@ -0,0 +1,36 @@
+import threading
+from collections import defaultdict
+
+
+class EventBus:
+    """Minimal in-process publish/subscribe bus"""
+    
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.lock = threading.Lock()
+    
+    def subscribe(self, topic, callback):
+        """
+        Register a callback for a topic
+        :param topic: Topic name, e.g. 'head_office.committed'
+        :param callback: Called with the event dictionary, on the publisher's thread
+        """
+        with self.lock:
+            self.subscribers[topic].append(callback)
+    
+    def unsubscribe(self, topic, callback):
+        """Remove a callback from a topic"""
+        with self.lock:
+            if callback in self.subscribers[topic]:
+                self.subscribers[topic].remove(callback)
+    
+    def publish(self, topic, event):
+        """Deliver an event to every subscriber of a topic"""
+        with self.lock:
+            callbacks = list(self.subscribers[topic])
+        
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Error in event bus subscriber for {topic}: {e}")
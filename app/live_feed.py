@@ -0,0 +1,201 @@
+import threading
+import time
+from db_connector import DatabaseConnector
+from config import BRANCH_SNAPSHOT_TTL
+
+# Columns of the sales_summary view
+SUMMARY_COLUMNS = ['formatted_date', 'region', 'product', 'qty', 'cost', 'amt', 'tax', 'total']
+
+
+class LiveDashboardFeed:
+    def __init__(self, event_bus, branches=('branch1', 'branch2')):
+        """
+        Coalesced dashboard feed shared by every connected client.
+        The head office table is loaded on first use (or on refresh), then kept
+        current from the commit events the consumer publishes on the event bus.
+        Branch tables are cached for BRANCH_SNAPSHOT_TTL seconds and refreshed when
+        a branch signals a change.
+        :param event_bus: EventBus carrying 'head_office.committed' and 'branch.changed' events
+        """
+        self.event_bus = event_bus
+        self.head_office_db = DatabaseConnector('head_office')
+        self.branch_dbs = {branch: DatabaseConnector(branch) for branch in branches}
+        
+        # Guards the rows, totals and version; held only for dictionary updates so
+        # the consumer thread is never blocked by a render or a database query
+        self.lock = threading.Lock()
+        self.head_office_rows = None
+        self.totals = {}
+        self.version = 0
+        self.loaded_at = None
+        self.events_while_loading = None
+        
+        # Serializes loads and renders, concurrent clients reuse the result
+        self.render_lock = threading.Lock()
+        self.rendered = None
+        
+        self.branch_lock = threading.Lock()
+        self.branch_snapshots = {}
+    
+    def start(self):
+        """Subscribe to the event bus"""
+        self.event_bus.subscribe('head_office.committed', self.on_head_office_committed)
+        self.event_bus.subscribe('branch.changed', self.on_branch_changed)
+    
+    @staticmethod
+    def summary_row(source_branch, sale):
+        """Format a sale the way the head office sales_summary view does"""
+        return {
+            'formatted_date': sale['date'].strftime('%d-%b'),
+            'region': sale['region'],
+            'product': sale['product'],
+            'qty': sale['qty'],
+            'cost': sale['cost'],
+            'amt': sale['amt'],
+            'tax': sale['tax'],
+            'total': sale['total'],
+            'source_branch': source_branch,
+            # Sort key of the view: date, region, product
+            'sort_key': (sale['date'], sale['region'], sale['product'])
+        }
+    
+    def _apply(self, key, row):
+        """Set or remove (row None) one head office row and update the totals, the lock must be held"""
+        old_row = self.head_office_rows.pop(key, None)
+        
+        for sign, changed in ((-1, old_row), (1, row)):
+            if changed is None:
+                continue
+            branch_totals = self.totals.setdefault(changed['source_branch'], {'sales': 0, 'qty': 0, 'total': 0})
+            branch_totals['sales'] += sign
+            branch_totals['qty'] += sign * changed['qty']
+            branch_totals['total'] += sign * changed['total']
+        
+        if row is not None:
+            self.head_office_rows[key] = row
+    
+    def _event_row(self, event):
+        """Build the (key, row) delta of a commit event, row is None for deletes"""
+        key = (event['branch'], event['sale_id'])
+        if event['event'] == 'delete':
+            return key, None
+        
+        sale = event['sale']
+        return key, self.summary_row(event['branch'], {
+            'date': sale.date, 'region': sale.region, 'product': sale.product,
+            'qty': sale.qty, 'cost': sale.cost, 'amt': sale.amt,
+            'tax': sale.tax, 'total': sale.total
+        })
+    
+    def _load_head_office(self):
+        """
+        (Re)load the head office table, the render lock must be held.
+        The query runs without the feed lock. Commits that arrive meanwhile are
+        replayed on top of the result, which is safe because deltas are idempotent.
+        """
+        with self.lock:
+            self.events_while_loading = []
+        
+        self.head_office_db.connect()
+        sales = self.head_office_db.get_all_sales()
+        self.head_office_db.disconnect()
+        
+        with self.lock:
+            events = self.events_while_loading
+            self.events_while_loading = None
+            
+            if sales is None:
+                print("Failed to load the head office table for the live feed")
+                if self.head_office_rows is not None:
+                    return
+                sales = []
+            
+            self.head_office_rows = {}
+            self.totals = {}
+            for sale in sales:
+                key = (sale['source_branch'], sale['original_sale_id'])
+                self._apply(key, self.summary_row(sale['source_branch'], sale))
+            
+            for event in events:
+                self._apply(*self._event_row(event))
+            
+            self.loaded_at = time.monotonic()
+            self.version += 1
+    
+    def on_head_office_committed(self, event):
+        """Apply a row delta published by the consumer"""
+        with self.lock:
+            # Keep the commit for the load in progress
+            if self.events_while_loading is not None:
+                self.events_while_loading.append(event)
+            
+            # Nothing to patch until a client asked for the table
+            if self.head_office_rows is None:
+                return
+            
+            self._apply(*self._event_row(event))
+            self.version += 1
+    
+    def on_branch_changed(self, event):
+        """Drop a branch snapshot after new sales were added to it"""
+        with self.branch_lock:
+            self.branch_snapshots.pop(event['branch'], None)
+    
+    def reload_head_office(self):
+        """Reload the head office table from the database, e.g. on a manual refresh"""
+        with self.render_lock:
+            self._load_head_office()
+    
+    def get_head_office(self, max_age=None):
+        """
+        Get the head office table and per-branch aggregates.
+        Gradio data frames cannot be patched row by row, so clients receive a full
+        snapshot, but it is rendered once per version and shared by all of them, and
+        only when the version moved (the consumer applies the row deltas).
+        :param max_age: Reload the table if it is older than this many seconds, for when
+                        commits are made by another process and no events arrive
+        :return: (version, rows, aggregates)
+        """
+        with self.render_lock:
+            if self.head_office_rows is None or (
+                max_age is not None and time.monotonic() - self.loaded_at >= max_age
+            ):
+                self._load_head_office()
+            
+            with self.lock:
+                version = self.version
+                if self.rendered is not None and self.rendered[0] == version:
+                    return self.rendered
+                
+                # Copy under the lock, sort outside it
+                snapshot = list(self.head_office_rows.values())
+                aggregates = [
+                    {'source_branch': branch, **branch_totals}
+                    for branch, branch_totals in sorted(self.totals.items())
+                    if branch_totals['sales']
+                ]
+            
+            snapshot.sort(key=lambda row: row['sort_key'])
+            rows = [
+                {column: row[column] for column in SUMMARY_COLUMNS + ['source_branch']}
+                for row in snapshot
+            ]
+            
+            self.rendered = (version, rows, aggregates)
+            return self.rendered
+    
+    def get_branch(self, branch_name):
+        """Get a branch's sales summary, shared between clients for BRANCH_SNAPSHOT_TTL seconds"""
+        with self.branch_lock:
+            snapshot = self.branch_snapshots.get(branch_name)
+            if snapshot and time.monotonic() - snapshot[0] < BRANCH_SNAPSHOT_TTL:
+                return snapshot[1]
+            
+            # Concurrent requests wait here and reuse this query's result
+            db = self.branch_dbs[branch_name]
+            db.connect()
+            rows = db.get_sales_summary() or []
+            db.disconnect()
+            
+            self.branch_snapshots[branch_name] = (time.monotonic(), rows)
+            return rows
@@ -1,36 +1,68 @@
-import gradio as gr
-import pandas as pd
-from datetime import datetime, date
-import threading
 import time
-import schedule
-from db_connector import DatabaseConnector
-from producer import SalesProducer
+
+# Taken before any other import so startup time includes module loading
+START_TIME = time.perf_counter()
+
+import argparse
+import signal
+from datetime import datetime, date
+from producer import SalesProducer, OutboxRelay
+from amqp_connection import AMQPConnectionManager
 from consumer import SalesConsumer
-from config import SYNC_INTERVAL
+from reconciler import SalesReconciler
+from sync_scheduler import SyncScheduler
+from sale_record import SaleRecord
+from bulk_import import read_sales_file, validate_sales_file
+from event_bus import EventBus
+from live_feed import LiveDashboardFeed
+from profiling import MODES, PipelineProfiler
+from config import SYNC_INTERVAL, LIVE_REFRESH_INTERVAL, HEAD_OFFICE_RELOAD_INTERVAL, PROFILE_OUTPUT_DIR
 
 class SalesSyncApp:
     def __init__(self):
         """Initialize the sales synchronization application"""
-        self.head_office_db = DatabaseConnector('head_office')
-        self.branch1_db = DatabaseConnector('branch1')
-        self.branch2_db = DatabaseConnector('branch2')
+        # In-process events feed the live dashboard
+        self.event_bus = EventBus()
+        self.live_feed = LiveDashboardFeed(self.event_bus)
+        self.live_feed.start()
         
         self.branch1_producer = SalesProducer('branch1')
         self.branch2_producer = SalesProducer('branch2')
+        self.branch1_producer.event_bus = self.event_bus
+        self.branch2_producer.event_bus = self.event_bus
+        
+        # Outbox relays publish new sales as soon as they are committed
+        self.branch1_relay = OutboxRelay('branch1')
+        self.branch2_relay = OutboxRelay('branch2')
+        self.branch1_producer.relay = self.branch1_relay
+        self.branch2_producer.relay = self.branch2_relay
+        
+        # Reconcilers repair updated and deleted sales
+        self.branch1_reconciler = SalesReconciler('branch1')
+        self.branch2_reconciler = SalesReconciler('branch2')
         
-        self.consumer = SalesConsumer()
+        self.consumer = SalesConsumer(event_bus=self.event_bus)
         self.consumer_thread = None
         
-        self.scheduler_thread = None
-        self.scheduler_running = False
+        # Per-branch scheduler, at most one sync in flight per branch
+        self.scheduler = SyncScheduler(self.run_scheduled_sync, ['branch1', 'branch2'])
         
         # Flags to track pending changes
         self.branch1_has_changes = False
         self.branch2_has_changes = False
         
-        # Start consumer automatically on initialization
+    def start_services(self):
+        """Start the consumer and the outbox relays"""
         self.start_consumer()
+        self.branch1_relay.start()
+        self.branch2_relay.start()
+    
+    def stop_services(self):
+        """Stop the scheduler, the outbox relays and the consumer"""
+        self.scheduler.stop()
+        self.branch1_relay.stop()
+        self.branch2_relay.stop()
+        self.stop_consumer()
     
     def start_consumer(self):
         """Start the consumer thread to process messages"""
@@ -50,14 +82,20 @@ class SalesSyncApp:
     
     def check_for_changes(self):
         """Check if there are changes to be synced in any branch"""
-        self.branch1_has_changes = self.branch1_producer.check_for_changes()
-        self.branch2_has_changes = self.branch2_producer.check_for_changes()
+        branch1_pending = self.branch1_producer.check_for_changes()
+        branch2_pending = self.branch2_producer.check_for_changes()
+        self.branch1_has_changes = branch1_pending > 0
+        self.branch2_has_changes = branch2_pending > 0
         
         message = []
         if self.branch1_has_changes:
-            message.append("Branch 1 has sales that need to be synced")
+            message.append(f"Branch 1 has {branch1_pending} sales that need to be synced")
+        elif self.branch1_producer.check_for_modifications():
+            message.append("Branch 1 had updates or deletes since the last check, run a reconciliation")
         if self.branch2_has_changes:
-            message.append("Branch 2 has sales that need to be synced")
+            message.append(f"Branch 2 has {branch2_pending} sales that need to be synced")
+        elif self.branch2_producer.check_for_modifications():
+            message.append("Branch 2 had updates or deletes since the last check, run a reconciliation")
             
         if not message:
             message.append("No changes detected in any branch")
@@ -66,78 +104,88 @@ class SalesSyncApp:
     
     def sync_branch1(self):
         """Synchronize sales from Branch 1"""
-        count = self.branch1_producer.sync_all_sales()
+        count = self.scheduler.run_exclusive('branch1', self.branch1_producer.sync_all_sales)
+        if count is None:
+            return "A sync of Branch 1 is already in progress", False
         self.branch1_has_changes = False
         return f"Synchronized {count} sales from Branch 1", False
     
     def sync_branch2(self):
         """Synchronize sales from Branch 2"""
-        count = self.branch2_producer.sync_all_sales()
+        count = self.scheduler.run_exclusive('branch2', self.branch2_producer.sync_all_sales)
+        if count is None:
+            return "A sync of Branch 2 is already in progress", False
         self.branch2_has_changes = False
         return f"Synchronized {count} sales from Branch 2", False
     
     def sync_all_branches(self):
         """Synchronize sales from all branches"""
-        count1 = self.branch1_producer.sync_all_sales()
-        count2 = self.branch2_producer.sync_all_sales()
+        message = []
+        for branch_name, label, producer in [
+            ('branch1', 'Branch 1', self.branch1_producer),
+            ('branch2', 'Branch 2', self.branch2_producer)
+        ]:
+            count = self.scheduler.run_exclusive(branch_name, producer.sync_all_sales)
+            if count is None:
+                message.append(f"a sync of {label} is already in progress")
+            else:
+                message.append(f"{count} sales from {label}")
+        
         self.branch1_has_changes = False
         self.branch2_has_changes = False
-        return f"Synchronized {count1} sales from Branch 1 and {count2} sales from Branch 2"
+        return "Synchronized " + " and ".join(message)
+    
+    def run_scheduled_sync(self, branch_name):
+        """
+        Scheduled sync job for one branch
+        :return: Number of sales synced, used to adapt the interval
+        """
+        producer = self.branch1_producer if branch_name == 'branch1' else self.branch2_producer
+        return producer.sync_pending_sales()
+    
+    def reconcile_all_branches(self):
+        """Re-send the sales that differ between each branch and the head office"""
+        try:
+            result1 = self.branch1_reconciler.reconcile()
+            result2 = self.branch2_reconciler.reconcile()
+        except Exception as e:
+            return f"Error reconciling branches: {str(e)}"
+        
+        return (
+            f"Branch 1: {result1['upserts']} upserts, {result1['deletes']} deletes; "
+            f"Branch 2: {result2['upserts']} upserts, {result2['deletes']} deletes"
+        )
     
     def start_auto_sync(self):
-        """Start automatic synchronization at regular intervals"""
-        if self.scheduler_running:
-            return "Auto sync is already running"
+        """Start automatic synchronization at adaptive per-branch intervals"""
+        if self.scheduler.is_running:
+            intervals = ", ".join(
+                f"{branch_name} every {interval:.0f}s" for branch_name, interval in self.scheduler.get_intervals().items()
+            )
+            return f"Auto sync is already running ({intervals})"
         
-        def run_schedule():
-            self.scheduler_running = True
-            
-            # Define the sync job
-            def sync_job():
-                print(f"Running scheduled sync at {datetime.now()}")
-                self.sync_all_branches()
-            
-            # Schedule the job
-            schedule.every(SYNC_INTERVAL).seconds.do(sync_job)
-            
-            # Start the consumer if not running
-            if not self.consumer.is_consuming:
-                self.consumer.start_consuming()
-            
-            # Run the scheduler
-            while self.scheduler_running:
-                schedule.run_pending()
-                time.sleep(1)
+        # Start the consumer if not running
+        if not self.consumer.is_consuming:
+            self.consumer.start_consuming()
         
-        # Start the scheduler in a separate thread
-        self.scheduler_thread = threading.Thread(target=run_schedule)
-        self.scheduler_thread.daemon = True
-        self.scheduler_thread.start()
+        self.scheduler.start()
         
-        return f"Auto sync started. Will sync every {SYNC_INTERVAL} seconds"
+        return f"Auto sync started. Will sync every {SYNC_INTERVAL} seconds, adapting to each branch's activity"
     
     def stop_auto_sync(self):
         """Stop automatic synchronization"""
-        if not self.scheduler_running:
+        if not self.scheduler.is_running:
             return "Auto sync is not running"
         
-        # Stop the scheduler
-        self.scheduler_running = False
-        
-        # Wait for the thread to complete
-        if self.scheduler_thread and self.scheduler_thread.is_alive():
-            self.scheduler_thread.join(timeout=2)
-        
-        # Clear all scheduled jobs
-        schedule.clear()
+        self.scheduler.stop()
         
         return "Auto sync stopped"
     
     def get_branch1_sales(self):
         """Get sales data from Branch 1"""
-        self.branch1_db.connect()
-        sales = self.branch1_db.get_sales_summary()
-        self.branch1_db.disconnect()
+        import pandas as pd
+        
+        sales = self.live_feed.get_branch('branch1')
         
         if not sales:
             return pd.DataFrame()
@@ -146,9 +194,9 @@ class SalesSyncApp:
     
     def get_branch2_sales(self):
         """Get sales data from Branch 2"""
-        self.branch2_db.connect()
-        sales = self.branch2_db.get_sales_summary()
-        self.branch2_db.disconnect()
+        import pandas as pd
+        
+        sales = self.live_feed.get_branch('branch2')
         
         if not sales:
             return pd.DataFrame()
@@ -156,15 +204,33 @@ class SalesSyncApp:
         return pd.DataFrame(sales)
     
     def get_head_office_sales(self):
-        """Get sales data from Head Office"""
-        self.head_office_db.connect()
-        sales = self.head_office_db.get_sales_summary()
-        self.head_office_db.disconnect()
+        """Reload sales data from Head Office"""
+        import pandas as pd
         
-        if not sales:
-            return pd.DataFrame()
+        # A manual refresh always goes to the database
+        self.live_feed.reload_head_office()
+        version, sales, aggregates = self.live_feed.get_head_office()
         
-        return pd.DataFrame(sales)
+        return pd.DataFrame(sales), pd.DataFrame(aggregates), version
+    
+    def poll_live_feed(self, known_version):
+        """
+        Push head office changes to a client from the shared live feed
+        :param known_version: Feed version the client last rendered
+        :return: Head office table, per-branch totals and the new version
+        """
+        import gradio as gr
+        import pandas as pd
+        
+        # Commits made by headless consume workers never reach this process's event
+        # bus, so the table is reloaded periodically even while our consumer runs
+        version, sales, aggregates = self.live_feed.get_head_office(max_age=HEAD_OFFICE_RELOAD_INTERVAL)
+        
+        # Nothing changed since this client's last update
+        if version == known_version:
+            return gr.update(), gr.update(), version
+        
+        return pd.DataFrame(sales), pd.DataFrame(aggregates), version
     
     def add_new_sale_to_branch1(self, date_str, region, product, qty, cost, amt, tax, total):
         """Add a new sale to Branch 1"""
@@ -177,24 +243,19 @@ class SalesSyncApp:
             tax = float(tax)
             total = float(total)
             
-            # Create sale data
-            sale_data = {
-                'date': sale_date,
-                'region': region,
-                'product': product,
-                'qty': qty,
-                'cost': cost,
-                'amt': amt,
-                'tax': tax,
-                'total': total
-            }
+            # Create sale record, the branch generates the sale_id
+            sale = SaleRecord(None, sale_date, region, product, qty, cost, amt, tax, total)
             
             # Add and sync the sale
-            success = self.branch1_producer.add_and_sync_new_sale(sale_data)
+            status = self.branch1_producer.add_and_sync_new_sale(sale)
             
-            if success:
+            if status == 'published':
                 return "Sale added to Branch 1 and synchronized to Head Office"
+            elif status == 'queued':
+                return "Sale added to Branch 1 and queued for publishing to Head Office"
             else:
+                # The sale may be saved but not yet published, let the scheduler catch up now
+                self.scheduler.trigger('branch1')
                 return "Failed to add sale"
                 
         except Exception as e:
@@ -211,31 +272,54 @@ class SalesSyncApp:
             tax = float(tax)
             total = float(total)
             
-            # Create sale data
-            sale_data = {
-                'date': sale_date,
-                'region': region,
-                'product': product,
-                'qty': qty,
-                'cost': cost,
-                'amt': amt,
-                'tax': tax,
-                'total': total
-            }
+            # Create sale record, the branch generates the sale_id
+            sale = SaleRecord(None, sale_date, region, product, qty, cost, amt, tax, total)
             
             # Add and sync the sale
-            success = self.branch2_producer.add_and_sync_new_sale(sale_data)
+            status = self.branch2_producer.add_and_sync_new_sale(sale)
             
-            if success:
+            if status == 'published':
                 return "Sale added to Branch 2 and synchronized to Head Office"
+            elif status == 'queued':
+                return "Sale added to Branch 2 and queued for publishing to Head Office"
             else:
+                # The sale may be saved but not yet published, let the scheduler catch up now
+                self.scheduler.trigger('branch2')
                 return "Failed to add sale"
                 
         except Exception as e:
             return f"Error adding sale: {str(e)}"
     
+    def import_sales_file(self, file_path, branch_name):
+        """Bulk import a CSV or Parquet file of sales into a branch"""
+        if not file_path:
+            return "Please choose a CSV or Parquet file"
+        
+        producer = self.branch1_producer if branch_name == 'branch1' else self.branch2_producer
+        
+        # Check every row first, so a bad row does not leave a partial import behind
+        try:
+            validate_sales_file(file_path)
+        except Exception as e:
+            return f"Nothing was imported: {str(e)}"
+        
+        try:
+            result = producer.bulk_add_and_sync(read_sales_file(file_path))
+        except Exception as e:
+            return f"Error importing sales: {str(e)}"
+        
+        if not result['count']:
+            return "No sales were imported"
+        
+        return (
+            f"Imported {result['count']} sales into {branch_name} "
+            f"(sale_id {result['first_sale_id']} to {result['last_sale_id']}), publishing to Head Office"
+        )
+    
     def launch_ui(self):
         """Launch the Gradio UI"""
+        import gradio as gr
+        
         with gr.Blocks(title="Distributed Database Synchronization") as app:
             gr.Markdown("# Distributed Database Synchronization with RabbitMQ")
             
@@ -256,21 +340,27 @@ class SalesSyncApp:
                                 sync_branch2_btn = gr.Button("Sync Branch 2", visible=False)
                             
                             sync_all_btn = gr.Button("Sync All Branches")
-                            start_auto_btn = gr.Button("Start Auto Sync (60s)")
+                            reconcile_btn = gr.Button("Reconcile Branches")
+                            start_auto_btn = gr.Button("Start Auto Sync")
                             stop_auto_btn = gr.Button("Stop Auto Sync")
                             status_output = gr.Textbox(label="Status", lines=1)
                         
                     gr.Markdown("### Branch 1 Sales")
-                    branch1_df = gr.DataFrame(self.get_branch1_sales())
+                    branch1_df = gr.DataFrame()
                     refresh_branch1_btn = gr.Button("Refresh Branch 1 Data")
                     
                     gr.Markdown("### Branch 2 Sales")
-                    branch2_df = gr.DataFrame(self.get_branch2_sales())
+                    branch2_df = gr.DataFrame()
                     refresh_branch2_btn = gr.Button("Refresh Branch 2 Data")
                     
-                    gr.Markdown("### Head Office Sales")
-                    head_office_df = gr.DataFrame(self.get_head_office_sales())
+                    gr.Markdown("### Head Office Sales (live)")
+                    head_office_totals_df = gr.DataFrame()
+                    head_office_df = gr.DataFrame()
                     refresh_ho_btn = gr.Button("Refresh Head Office Data")
+                    
+                    # Every client polls the same coalesced feed, no per-client queries
+                    live_version = gr.State(-1)
+                    live_timer = gr.Timer(LIVE_REFRESH_INTERVAL)
                 
                 with gr.TabItem("Add New Sales"):
                     with gr.Row():
@@ -307,6 +397,18 @@ class SalesSyncApp:
                             total_input2 = gr.Number(label="Total", value=46.87)
                             add_branch2_btn = gr.Button("Add Sale to Branch 2")
                             status_branch2 = gr.Textbox(label="Status", lines=1)
+                    
+                    gr.Markdown("### Bulk Import (end-of-day dumps)")
+                    with gr.Row():
+                        import_file = gr.File(
+                            label="Sales file (CSV or Parquet with date, region, product, qty, cost, amt, tax, total)",
+                            file_types=[".csv", ".parquet"],
+                            type="filepath"
+                        )
+                        with gr.Column():
+                            import_branch = gr.Dropdown(label="Branch", choices=["branch1", "branch2"], value="branch1")
+                            import_btn = gr.Button("Import Sales")
+                            status_import = gr.Textbox(label="Status", lines=2)
             
             # Event handlers
             start_consumer_btn.click(self.start_consumer, inputs=[], outputs=[status_output])
@@ -333,6 +435,7 @@ class SalesSyncApp:
             )
             
             sync_all_btn.click(self.sync_all_branches, inputs=[], outputs=[status_output])
+            reconcile_btn.click(self.reconcile_all_branches, inputs=[], outputs=[status_output])
             start_auto_btn.click(self.start_auto_sync, inputs=[], outputs=[status_output])
             stop_auto_btn.click(self.stop_auto_sync, inputs=[], outputs=[status_output])
             
@@ -352,7 +455,7 @@ class SalesSyncApp:
             refresh_ho_btn.click(
                 self.get_head_office_sales, 
                 inputs=[], 
-                outputs=[head_office_df]
+                outputs=[head_office_df, head_office_totals_df, live_version]
             )
             
             # Add sale buttons
@@ -376,10 +479,148 @@ class SalesSyncApp:
                 outputs=[status_branch2]
             )
             
+            import_btn.click(
+                self.import_sales_file,
+                inputs=[import_file, import_branch],
+                outputs=[status_import]
+            )
+            
+            # Load the tables once the page is served instead of before startup
+            app.load(self.get_branch1_sales, inputs=[], outputs=[branch1_df])
+            app.load(self.get_branch2_sales, inputs=[], outputs=[branch2_df])
+            app.load(
+                self.poll_live_feed,
+                inputs=[live_version],
+                outputs=[head_office_df, head_office_totals_df, live_version]
+            )
+            
+            # Stream head office deltas and totals as the consumer commits them
+            live_timer.tick(
+                self.poll_live_feed,
+                inputs=[live_version],
+                outputs=[head_office_df, head_office_totals_df, live_version]
+            )
+            
         # Launch the app
         app.launch(server_name="0.0.0.0", server_port=7860, share=False)
 
 
+def report_startup(name):
+    """Print how long the process took to become ready"""
+    print(f"{name} ready in {time.perf_counter() - START_TIME:.3f}s")
+
+
+def handle_sigterm(signum, frame):
+    """Turn container stop signals into a clean shutdown"""
+    raise KeyboardInterrupt
+
+
+def handle_profile_toggle(signum, frame):
+    """SIGUSR2 cycles the profiling mode: off -> timing -> sampling -> off"""
+    PipelineProfiler.get_instance().cycle_mode()
+
+
+def handle_profile_dump(signum, frame):
+    """SIGUSR1 writes the profiling reports collected so far"""
+    PipelineProfiler.get_instance().write_reports(PROFILE_OUTPUT_DIR)
+
+
+def wait_until_interrupted(is_alive):
+    """Block the main thread while a worker is alive"""
+    try:
+        while is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Shutting down")
+
+
+def run_consumer(args):
+    """Headless head office consumer"""
+    consumer = SalesConsumer()
+    if not consumer.start_consuming():
+        return 1
+    
+    report_startup("Consumer")
+    wait_until_interrupted(lambda: consumer.is_consuming)
+    consumer.stop_consuming()
+    return 0
+
+
+def run_producer(args):
+    """Headless branch producer: outbox relay plus adaptive scheduled sync"""
+    relay = OutboxRelay(args.branch)
+    relay.start()
+    
+    scheduler = None
+    if not args.no_schedule:
+        producer = SalesProducer(args.branch)
+        scheduler = SyncScheduler(lambda branch_name: producer.sync_pending_sales(), [args.branch])
+        scheduler.start()
+    
+    report_startup(f"Producer for {args.branch}")
+    wait_until_interrupted(lambda: relay.is_running)
+    
+    if scheduler:
+        scheduler.stop()
+    relay.stop()
+    return 0
+
+
+def run_ui(args):
+    """Gradio dashboard with an in-process consumer and relays"""
+    sync_app = SalesSyncApp()
+    sync_app.start_services()
+    report_startup("Dashboard services")
+    try:
+        sync_app.launch_ui()
+    finally:
+        sync_app.stop_services()
+    return 0
+
+
+def parse_args():
+    """Parse the command line, defaulting to the UI"""
+    parser = argparse.ArgumentParser(description="Distributed sales synchronization")
+    parser.add_argument(
+        '--profile', choices=MODES,
+        help="Pipeline profiling mode (default: SALES_PROFILING or off), SIGUSR2 cycles it at runtime"
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    
+    consume_parser = subparsers.add_parser('consume', help="Run the head office consumer")
+    consume_parser.set_defaults(handler=run_consumer)
+    
+    produce_parser = subparsers.add_parser('produce', help="Run a branch producer")
+    produce_parser.add_argument('--branch', required=True, choices=['branch1', 'branch2'])
+    produce_parser.add_argument('--no-schedule', action='store_true', help="Only relay the outbox")
+    produce_parser.set_defaults(handler=run_producer)
+    
+    ui_parser = subparsers.add_parser('ui', help="Run the Gradio dashboard (default)")
+    ui_parser.set_defaults(handler=run_ui)
+    
+    args = parser.parse_args()
+    if not args.command:
+        args.handler = run_ui
+    return args
+
+
 if __name__ == "__main__":
-    test = SalesSyncApp()
-    test.launch_ui()
\ No newline at end of file
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    args = parse_args()
+    
+    profiler = PipelineProfiler.get_instance()
+    if args.profile:
+        profiler.set_mode(args.profile)
+    
+    # Profiling can be switched and dumped without restarting (not available on Windows)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handle_profile_dump)
+        signal.signal(signal.SIGUSR2, handle_profile_toggle)
+    
+    try:
+        exit_code = args.handler(args)
+    finally:
+        # Close the connections of every thread (e.g. Gradio workers) and the spill journal
+        AMQPConnectionManager.get_instance().close_all()
+        profiler.write_reports(PROFILE_OUTPUT_DIR)
+    raise SystemExit(exit_code)
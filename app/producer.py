@@ -1,9 +1,13 @@
 import pika
 import json
 import time
-from datetime import datetime, date
+import threading
+from datetime import datetime
 from db_connector import DatabaseConnector
-from config import RABBITMQ_CONFIG
+from sale_record import SaleRecord
+from amqp_connection import AMQPConnectionManager, get_routing_key
+from profiling import PipelineProfiler
+from config import RABBITMQ_CONFIG, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL
 
 class SalesProducer:
     def __init__(self, branch_name):
@@ -13,121 +17,110 @@ class SalesProducer:
         """
         self.branch_name = branch_name
         self.db = DatabaseConnector(branch_name)
-        self.connection = None
+        self.head_office_db = DatabaseConnector('head_office')
+        self.last_update_time = None  # (UPDATE_TIME, MAX(sale_id)) seen by the last check
+        self.amqp = AMQPConnectionManager.get_instance()
         self.channel = None
+        self.relay = None
+        self.event_bus = None
+        self.profiler = PipelineProfiler.get_instance()
         
     def connect_to_rabbitmq(self):
-        """Establish connection to RabbitMQ"""
-        try:
-            credentials = pika.PlainCredentials(
-                RABBITMQ_CONFIG['username'],
-                RABBITMQ_CONFIG['password']
-            )
-            
-            parameters = pika.ConnectionParameters(
-                host=RABBITMQ_CONFIG['host'],
-                port=RABBITMQ_CONFIG['port'],
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300
-            )
-            
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            
-            # Declare exchange
-            self.channel.exchange_declare(
-                exchange=RABBITMQ_CONFIG['exchange'],
-                exchange_type=RABBITMQ_CONFIG['exchange_type'],
-                durable=True
-            )
-            
-            # Declare queue
-            queue_name = RABBITMQ_CONFIG['queues'][f'{self.branch_name}_queue']
-            self.channel.queue_declare(
-                queue=queue_name,
-                durable=True
-            )
-            
-            # Bind queue to exchange
-            self.channel.queue_bind(
-                exchange=RABBITMQ_CONFIG['exchange'],
-                queue=queue_name,
-                routing_key=self.branch_name
-            )
-            
-            print(f"Connected to RabbitMQ and set up '{self.branch_name}' queue")
-            return True
-            
-        except Exception as e:
-            print(f"Error connecting to RabbitMQ: {e}")
+        """Get a warm channel from the shared connection manager"""
+        self.channel = self.amqp.get_channel()
+        
+        if not self.channel:
+            print("Error connecting to RabbitMQ")
             return False
+        
+        # Topology is declared once per process, not on every connection
+        return self.amqp.declare_branch_topology(self.branch_name)
     
     def close_connection(self):
-        """Close RabbitMQ connection"""
-        if self.connection and self.connection.is_open:
-            self.connection.close()
-            print("RabbitMQ connection closed")
+        """Release the channel, the shared connection stays open for reuse"""
+        self.channel = None
     
-    def send_sale_data(self, sale_data):
+    def publish_message(self, message, lane='realtime'):
         """
-        Send a single sale record to RabbitMQ
-        :param sale_data: Dictionary containing sale record data
+        Publish a message dictionary to the branch (or sale's shard) routing key
+        :param message: Message to publish, must contain 'sale_id'
+        :param lane: 'realtime' for new sales, 'bulk' for resync and import traffic
         """
-        if not self.connection or not self.connection.is_open:
+        if not self.channel or not self.channel.is_open:
             if not self.connect_to_rabbitmq():
                 print("Failed to connect to RabbitMQ")
                 return False
         
         try:
-            queue_name = RABBITMQ_CONFIG['queues'][f'{self.branch_name}_queue']
-            message = {
-                'sale_id': sale_data['sale_id'],
-                'date': sale_data['date'].isoformat() if isinstance(sale_data['date'], (datetime, date)) else sale_data['date'],
-                'region': sale_data['region'],
-                'product': sale_data['product'],
-                'qty': sale_data['qty'],
-                'cost': float(sale_data['cost']),
-                'amt': float(sale_data['amt']),
-                'tax': float(sale_data['tax']),
-                'total': float(sale_data['total']),
-                'branch': self.branch_name,
-                'timestamp': datetime.now().isoformat()
-            }
-            
             # Convert message to JSON
-            message_body = json.dumps(message)
+            with self.profiler.stage('encode'):
+                message_body = json.dumps(message)
             
-            # Publish message
-            self.channel.basic_publish(
-                exchange=RABBITMQ_CONFIG['exchange'],
-                routing_key=self.branch_name,
-                body=message_body,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
-                    content_type='application/json'
+            # Publish message on the shared warm channel
+            with self.profiler.stage('publish'):
+                published = self.amqp.publish(
+                    exchange=RABBITMQ_CONFIG['exchange'],
+                    routing_key=get_routing_key(self.branch_name, message['sale_id'], lane),
+                    body=message_body,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # Make message persistent
+                        content_type='application/json',
+                        headers=self.profiler.trace_headers()  # Trace id, only while profiling
+                    )
                 )
-            )
             
-            print(f"Sent sale_id {sale_data['sale_id']} to queue")
+            if not published:
+                print(f"Failed to publish sale_id {message['sale_id']}")
+                return False
+            
             return True
             
         except Exception as e:
             print(f"Error sending message to RabbitMQ: {e}")
             return False
     
-    def sync_all_sales(self):
-        """Send all sales to RabbitMQ (full sync)"""
-        # Connect to database
-        self.db.connect()
+    def send_sale_data(self, sale, event='insert', lane='realtime'):
+        """
+        Send a single sale record to RabbitMQ
+        :param sale: SaleRecord (or dictionary) containing sale record data
+        :param event: 'insert' for new sales, 'upsert' to overwrite the head office copy
+        :param lane: 'realtime' or 'bulk'
+        """
+        sale = SaleRecord.coerce(sale)
         
-        # Get all sales
-        all_sales = self.db.get_all_sales_for_sync()
+        with self.profiler.trace():
+            if not self.publish_message(sale.to_message(self.branch_name, event), lane):
+                return False
         
-        if not all_sales:
-            print(f"No sales found in {self.branch_name}")
-            return 0
+        print(f"Sent sale_id {sale.sale_id} to queue")
+        return True
+    
+    def send_delete_event(self, sale_id, lane='bulk'):
+        """
+        Tell the head office that a sale no longer exists in the branch
+        :param sale_id: Branch sale_id
+        :param lane: Deletes are found by reconciliation, so they default to the bulk lane
+        """
+        message = {
+            'sale_id': sale_id,
+            'branch': self.branch_name,
+            'event': 'delete',
+            'timestamp': datetime.now().isoformat()
+        }
         
+        if not self.publish_message(message, lane):
+            return False
+        
+        print(f"Sent delete event for sale_id {sale_id} to queue")
+        return True
+    
+    def send_sales(self, sales):
+        """
+        Send a list of sales to RabbitMQ on the bulk lane, in sale_id order.
+        Stops at the first failure: a later sale reaching the head office would move
+        its high-water mark past the failed one, and incremental syncs would skip it.
+        :return: Number of sales sent
+        """
         # Connect to RabbitMQ
         if not self.connect_to_rabbitmq():
             print("Failed to connect to RabbitMQ")
@@ -135,68 +128,315 @@ class SalesProducer:
         
         # Send each sale to RabbitMQ
         success_count = 0
-        for sale in all_sales:
-            if self.send_sale_data(sale):
-                success_count += 1
-                
-                # Small delay to prevent overloading
+        for sale in sales:
+            if not self.send_sale_data(sale, lane='bulk'):
+                print(f"Stopping sync of {self.branch_name} at sale_id {SaleRecord.coerce(sale).sale_id}, it is retried next run")
+                break
+            
+            success_count += 1
+            
+            # Small delay to prevent overloading
+            with self.profiler.stage('throttle'):
                 time.sleep(0.1)
         
-        # Close connections
         self.close_connection()
+        return success_count
+    
+    def sync_all_sales(self):
+        """Send all sales to RabbitMQ (full sync)"""
+        # Connect to database
+        self.db.connect()
+        
+        # Get all sales
+        with self.profiler.stage('branch.read'):
+            all_sales = self.db.get_all_sales_for_sync()
+        
+        if not all_sales:
+            print(f"No sales found in {self.branch_name}")
+            self.db.disconnect()
+            return 0
+        
+        success_count = self.send_sales(all_sales)
         self.db.disconnect()
         
         print(f"Synchronized {success_count} sales from {self.branch_name}")
         return success_count
+    
+    def sync_new_sales(self):
+        """
+        Send only the sales above the head office high-water mark (incremental sync)
+        Sales below the mark are assumed applied. With lanes or shards the head office
+        can apply a later sale before an earlier one that is still queued, which is
+        fine while the earlier message is in flight. A message that is dropped for good
+        (e.g. rejected as malformed) leaves a gap below the mark that only a
+        reconciliation or a full sync repairs.
+        Spilled messages do not move the mark until they drain, so the sync is skipped
+        while RabbitMQ is blocked or the journal is not empty, instead of spilling the
+        same sales again on every run.
+        """
+        if self.amqp.is_blocked() or not self.amqp.drain_journal():
+            print(f"RabbitMQ is blocked or spilled messages are pending, skipping the sync of {self.branch_name}")
+            return 0
+        
+        high_water_mark = self.get_head_office_high_water_mark()
+        if high_water_mark is None:
+            return 0
+        
+        self.db.connect()
+        with self.profiler.stage('branch.read'):
+            new_sales = self.db.get_all_sales_for_sync(after_sale_id=high_water_mark)
+        
+        if not new_sales:
+            print(f"No new sales found in {self.branch_name}")
+            self.db.disconnect()
+            return 0
+        
+        success_count = self.send_sales(new_sales)
+        self.db.disconnect()
+        
+        print(f"Synchronized {success_count} new sales from {self.branch_name}")
+        return success_count
 
-    def add_and_sync_new_sale(self, sale_data):
-        """Add a new sale to the branch database and sync it immediately"""
+    def sync_pending_sales(self):
+        """
+        Sync job for the scheduler: send the pending sales, if any
+        :return: Number of sales synced
+        """
+        if not self.check_for_changes():
+            print(f"No pending sales in {self.branch_name}")
+            return 0
+        
+        return self.sync_new_sales()
+
+    def publish_outbox(self, batch_size=OUTBOX_BATCH_SIZE):
+        """
+        Publish pending outbox entries in batches and delete them once confirmed
+        :param batch_size: Number of outbox entries fetched per batch
+        :return: Number of entries published
+        """
+        published_count = 0
+        
+        while True:
+            batch = self.db.get_outbox_batch(batch_size)
+            
+            if not batch:
+                break
+            
+            # Publish in outbox order and stop at the first failure to keep ordering
+            confirmed_ids = []
+            for outbox_id, lane, sale_id, sale in batch:
+                # The sale was deleted before it was published, the head office may
+                # still have it from an earlier sync
+                if sale is None:
+                    if not self.send_delete_event(sale_id, lane=lane):
+                        break
+                elif not self.send_sale_data(sale, lane=lane):
+                    break
+                confirmed_ids.append(outbox_id)
+            
+            if not self.db.delete_outbox_entries(confirmed_ids):
+                print(f"Failed to clear published outbox entries in {self.branch_name}")
+                break
+            
+            published_count += len(confirmed_ids)
+            
+            if len(confirmed_ids) < len(batch) or len(batch) < batch_size:
+                break
+        
+        if published_count:
+            print(f"Published {published_count} outbox entries from {self.branch_name}")
+        return published_count
+
+    def notify_branch_changed(self, count):
+        """Tell in-process listeners that sales were added to the branch"""
+        if self.event_bus:
+            self.event_bus.publish('branch.changed', {'branch': self.branch_name, 'count': count})
+
+    def add_and_sync_new_sale(self, sale):
+        """
+        Add a new sale (SaleRecord) to the branch database and sync it immediately
+        :return: 'published' if it was published here, 'queued' if it was handed over
+                 to the running outbox relay, None if it was not added or not published
+        """
         # Connect to database
         self.db.connect()
         
-        # Add new sale and get its ID
-        new_sale_id = self.db.add_new_sale(sale_data)
+        # Add new sale together with its outbox entry
+        new_sale_id = self.db.add_new_sale(sale)
         
         if not new_sale_id:
             print("Failed to add new sale")
             self.db.disconnect()
-            return False
+            return None
         
-        # Get the newly added sale
-        query = "SELECT * FROM product_sales WHERE sale_id = %s"
-        result = self.db.execute_query(query, (new_sale_id,))
+        self.notify_branch_changed(1)
         
-        if not result:
-            print("Failed to retrieve the new sale")
+        # Let the running relay publish it
+        if self.relay and self.relay.is_running:
+            self.relay.wake()
             self.db.disconnect()
-            return False
+            
+            print(f"Added new sale {new_sale_id} to {self.branch_name}, handed over to the outbox relay")
+            return 'queued'
         
-        new_sale = result[0]
+        # No relay running, drain the outbox ourselves
+        published_count = self.publish_outbox()
         
-        # Sync the new sale
-        if not self.connect_to_rabbitmq():
-            print("Failed to connect to RabbitMQ")
+        # Close connections
+        self.close_connection()
+        self.db.disconnect()
+        
+        if published_count:
+            print(f"Added and synchronized new sale from {self.branch_name}")
+            return 'published'
+        
+        print(f"Sale {new_sale_id} saved in {self.branch_name}, it stays in the outbox until published")
+        return None
+        
+    def bulk_add_and_sync(self, chunks):
+        """
+        Import many sales into the branch and publish them in one pass
+        :param chunks: Iterable of SaleRecord lists
+        :return: Dictionary with the imported sale_id range, the count and the number published
+        """
+        self.db.connect()
+        try:
+            first_sale_id, last_sale_id, count = self.db.bulk_add_sales(chunks)
+        except Exception:
             self.db.disconnect()
-            return False
+            raise
         
-        # Send the new sale
-        if self.send_sale_data(new_sale):
-            # Close connections
-            self.close_connection()
+        result = {
+            'first_sale_id': first_sale_id,
+            'last_sale_id': last_sale_id,
+            'count': count,
+            'published': 0
+        }
+        
+        if not count:
             self.db.disconnect()
-            
-            print(f"Added and synchronized new sale from {self.branch_name}")
-            return True
+            return result
+        
+        self.notify_branch_changed(count)
+        
+        # Let the running relay publish the batch, or drain the outbox ourselves
+        if self.relay and self.relay.is_running:
+            self.relay.wake()
+        else:
+            result['published'] = self.publish_outbox()
+            self.close_connection()
         
-        # Close connections
-        self.close_connection()
         self.db.disconnect()
         
-        return False
+        print(f"Imported {count} sales into {self.branch_name} (sale_id {first_sale_id} to {last_sale_id})")
+        return result
+        
+    def get_head_office_high_water_mark(self):
+        """
+        Get the highest sale_id of this branch applied by the head office
+        :return: The mark, 0 if the head office has no sales of this branch, or None
+                 if it could not be read (treating that as 0 would resend the whole branch)
+        """
+        if not self.head_office_db.connect():
+            return None
+        high_water_mark = self.head_office_db.get_max_sale_id(self.branch_name)
+        self.head_office_db.disconnect()
+        return high_water_mark
         
     def check_for_changes(self):
-        """Check if there are sales that need to be synced"""
+        """
+        Count the sales that need to be synced
+        :return: Number of pending sales (0 when up to date)
+        """
+        high_water_mark = self.get_head_office_high_water_mark()
+        if high_water_mark is None:
+            return 0
+        
         self.db.connect()
-        has_changes = self.db.check_for_unsynced_sales()
+        pending_count = self.db.check_for_unsynced_sales(high_water_mark)
         self.db.disconnect()
-        return has_changes
\ No newline at end of file
+        return pending_count or 0
+    
+    def check_for_modifications(self):
+        """
+        Check whether product_sales had updates or deletes since the previous call
+        InnoDB UPDATE_TIME moves on every write, inserts included. A write that did not
+        also raise MAX(sale_id) was an update or delete, which needs a reconciliation
+        rather than a sync. An update made in the same interval as an insert is not
+        flagged, Reconcile Branches still repairs it.
+        """
+        self.db.connect()
+        update_time = self.db.get_last_update_time()
+        max_sale_id = self.db.get_max_sale_id()
+        self.db.disconnect()
+        
+        previous = self.last_update_time
+        self.last_update_time = (update_time, max_sale_id)
+        
+        if update_time is None or previous is None:
+            return False
+        
+        previous_update_time, previous_max_sale_id = previous
+        return update_time != previous_update_time and max_sale_id == previous_max_sale_id
+
+
+class OutboxRelay:
+    def __init__(self, branch_name):
+        """
+        Long-lived relay that publishes a branch's outbox to RabbitMQ
+        :param branch_name: 'branch1' or 'branch2'
+        """
+        self.branch_name = branch_name
+        # Dedicated producer so the relay thread owns its DB and AMQP connections
+        self.producer = SalesProducer(branch_name)
+        self.thread = None
+        self.is_running = False
+        self.wakeup = threading.Event()
+    
+    def wake(self):
+        """Ask the relay to drain the outbox now instead of waiting for the next poll"""
+        self.wakeup.set()
+    
+    def start(self):
+        """Start relaying in a separate thread"""
+        if self.is_running:
+            return False
+        
+        def relay_thread():
+            print(f"Started outbox relay for {self.branch_name}")
+            self.producer.db.connect()
+            try:
+                while self.is_running:
+                    try:
+                        # Keep the relay's connection alive between batches and
+                        # drain publishes spilled while RabbitMQ was blocked
+                        self.producer.amqp.keepalive()
+                        self.producer.amqp.drain_journal()
+                        self.producer.publish_outbox()
+                    except Exception as e:
+                        print(f"Outbox relay error in {self.branch_name}: {e}")
+                    
+                    self.wakeup.wait(OUTBOX_POLL_INTERVAL)
+                    self.wakeup.clear()
+            finally:
+                # Callers fall back to publishing themselves once the relay is gone
+                self.is_running = False
+                self.producer.close_connection()
+                self.producer.amqp.close()
+                self.producer.db.disconnect()
+                print(f"Stopped outbox relay for {self.branch_name}")
+        
+        self.is_running = True
+        self.thread = threading.Thread(target=relay_thread)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        return True
+    
+    def stop(self):
+        """Stop the relay thread"""
+        self.is_running = False
+        self.wakeup.set()
+        
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=5)
@@ -0,0 +1,302 @@
+import os
+import sys
+import time
+import uuid
+import threading
+from collections import Counter, defaultdict, deque
+from config import PROFILE_MODE, PROFILE_SAMPLE_INTERVAL, PROFILE_MAX_SAMPLES, PROFILE_MAX_TRACES
+
+MODES = ('off', 'timing', 'sampling')
+
+
+class _NullContext:
+    """Shared no-op context returned while timing is off"""
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_CONTEXT = _NullContext()
+
+
+class _Stage:
+    """Times one pipeline stage, nested stages are recorded under their parent's path"""
+    __slots__ = ('profiler', 'name', 'stack', 'start', 'child_time')
+    
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.child_time = 0.0
+    
+    def __enter__(self):
+        self.stack = self.profiler._stack()
+        self.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        path = ';'.join(stage.name for stage in self.stack)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].child_time += elapsed
+        self.profiler.record(self.name, elapsed, path, self_seconds=elapsed - self.child_time)
+        return False
+
+
+class _Trace:
+    """Makes a trace id current on this thread so stages are recorded under it"""
+    __slots__ = ('local', 'trace_id', 'previous')
+    
+    def __init__(self, local, trace_id):
+        self.local = local
+        self.trace_id = trace_id
+    
+    def __enter__(self):
+        self.previous = getattr(self.local, 'trace_id', None)
+        self.local.trace_id = self.trace_id
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.local.trace_id = self.previous
+        return False
+
+
+class PipelineProfiler:
+    """
+    Optional instrumentation of the sync pipeline.
+    Modes:
+    - 'off': stage() returns a shared no-op context, nothing is recorded
+    - 'timing': per-stage wall times, nested into flame graph paths and tagged
+      with the trace id carried in the AMQP headers from producer to consumer
+    - 'sampling': stage timers are off and a background thread samples the stacks
+      of every thread, so cProfile or py-spy can run alongside without double timing
+    The mode can be switched at runtime with set_mode() or cycle_mode().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+    
+    @classmethod
+    def get_instance(cls):
+        """Get the process-wide profiler"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+    
+    def __init__(self, mode=PROFILE_MODE):
+        """
+        Initialize the profiler
+        :param mode: 'off', 'timing' or 'sampling'
+        """
+        self.mode = 'off'
+        self.timing = False
+        self.durations = defaultdict(lambda: deque(maxlen=PROFILE_MAX_SAMPLES))
+        self.stage_stacks = Counter()
+        self.sampled_stacks = Counter()
+        self.traces = deque(maxlen=PROFILE_MAX_TRACES)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.sampler_stop = threading.Event()
+        self.set_mode(mode)
+    
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+    
+    def stage(self, name):
+        """
+        Time a pipeline stage
+        :param name: Stage name, e.g. 'encode' or 'head_office.write'
+        :return: Context manager, a shared no-op one while timing is off
+        """
+        if not self.timing:
+            return NULL_CONTEXT
+        return _Stage(self, name)
+    
+    def trace(self, trace_id=None):
+        """
+        Record the stages run inside the context under a trace id
+        :param trace_id: Id received from the producer, a new one is created if None
+        """
+        if not self.timing:
+            return NULL_CONTEXT
+        return _Trace(self.local, trace_id or uuid.uuid4().hex[:16])
+    
+    def trace_headers(self):
+        """
+        AMQP headers carrying the current trace to the consumer
+        :return: Header dictionary, or None while timing is off
+        """
+        if not self.timing:
+            return None
+        
+        trace_id = getattr(self.local, 'trace_id', None) or uuid.uuid4().hex[:16]
+        return {'trace_id': trace_id, 'sent_at': time.time()}
+    
+    def record_transit(self, headers):
+        """
+        Record the time a message spent between publish and delivery.
+        Uses wall clocks of both hosts, so it is only as exact as their clock sync.
+        """
+        sent_at = headers.get('sent_at') if headers else None
+        if self.timing and sent_at:
+            self.record('transit', max(time.time() - sent_at, 0.0), 'transit', headers.get('trace_id'))
+    
+    def record(self, name, seconds, path=None, trace_id=None, self_seconds=None):
+        """
+        Record one stage duration
+        :param name: Stage name
+        :param seconds: Elapsed time, nested stages included
+        :param path: ';'-joined stage path for the flame graph, defaults to the name
+        :param trace_id: Trace id, defaults to the current trace of this thread
+        :param self_seconds: Elapsed time outside nested stages, defaults to seconds.
+                             Flame graphs add the children to their parent themselves.
+        """
+        if trace_id is None:
+            trace_id = getattr(self.local, 'trace_id', None)
+        if self_seconds is None:
+            self_seconds = seconds
+        
+        with self.lock:
+            self.durations[name].append(seconds)
+            self.stage_stacks[path or name] += int(self_seconds * 1_000_000)
+            if trace_id:
+                self.traces.append((trace_id, name, seconds))
+    
+    def set_mode(self, mode):
+        """
+        Switch the profiling mode
+        :param mode: 'off', 'timing' or 'sampling'
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, expected one of {MODES}")
+        
+        if self.sampler and mode != 'sampling':
+            self.sampler_stop.set()
+            self.sampler.join()
+            self.sampler = None
+        
+        self.timing = mode == 'timing'
+        
+        if mode == 'sampling' and not self.sampler:
+            self.sampler_stop.clear()
+            self.sampler = threading.Thread(target=self._sample_loop, name='profiler-sampler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        
+        if mode != self.mode:
+            print(f"Profiling mode: {mode}")
+        self.mode = mode
+    
+    def cycle_mode(self):
+        """Switch to the next mode: off -> timing -> sampling -> off"""
+        self.set_mode(MODES[(MODES.index(self.mode) + 1) % len(MODES)])
+        return self.mode
+    
+    def _sample_loop(self):
+        """Periodically record the stack of every other thread"""
+        own_id = threading.get_ident()
+        
+        while not self.sampler_stop.wait(PROFILE_SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                
+                frames.append(names.get(thread_id, str(thread_id)))
+                stack = ';'.join(reversed(frames))
+                
+                with self.lock:
+                    self.sampled_stacks[stack] += 1
+    
+    def percentile_report(self, percentiles=(50, 90, 99)):
+        """
+        Per-stage latency percentiles over the most recent PROFILE_MAX_SAMPLES calls
+        :return: List of dictionaries with stage, count, p50_ms ... and max_ms
+        """
+        with self.lock:
+            durations = {name: sorted(values) for name, values in self.durations.items() if values}
+        
+        report = []
+        for name, values in sorted(durations.items()):
+            row = {'stage': name, 'count': len(values)}
+            for percentile in percentiles:
+                # Nearest-rank percentile
+                rank = max(int(round(percentile / 100 * len(values))) - 1, 0)
+                row[f'p{percentile}_ms'] = round(values[rank] * 1000, 3)
+            row['max_ms'] = round(values[-1] * 1000, 3)
+            report.append(row)
+        
+        return report
+    
+    def folded_stacks(self, source='stages'):
+        """
+        Flame graph input in collapsed stack format ("a;b;c value" per line),
+        readable by flamegraph.pl, speedscope and inferno
+        :param source: 'stages' for stage times in microseconds, 'samples' for sample counts
+        """
+        with self.lock:
+            stacks = dict(self.stage_stacks if source == 'stages' else self.sampled_stacks)
+        
+        return '\n'.join(f"{stack} {value}" for stack, value in sorted(stacks.items()))
+    
+    def write_reports(self, directory):
+        """
+        Write the percentile report, the most recent traces and both flame graph inputs
+        :param directory: Output directory, created if needed
+        :return: List of written file paths
+        """
+        if not self.durations and not self.sampled_stacks:
+            return []
+
+        os.makedirs(directory, exist_ok=True)
+        suffix = f"{os.getpid()}-{int(time.time())}"
+        paths = []
+        
+        report = self.percentile_report()
+        if report:
+            path = os.path.join(directory, f"stages-{suffix}.txt")
+            columns = list(report[0].keys())
+            with open(path, 'w') as output:
+                output.write('\t'.join(columns) + '\n')
+                for row in report:
+                    output.write('\t'.join(str(row[column]) for column in columns) + '\n')
+            paths.append(path)
+        
+        with self.lock:
+            traces = list(self.traces)
+        if traces:
+            # Producer and consumer stages of one sale share a trace id
+            path = os.path.join(directory, f"traces-{suffix}.txt")
+            with open(path, 'w') as output:
+                output.write('trace_id\tstage\tms\n')
+                for trace_id, name, seconds in traces:
+                    output.write(f"{trace_id}\t{name}\t{round(seconds * 1000, 3)}\n")
+            paths.append(path)
+        
+        for source in ['stages', 'samples']:
+            folded = self.folded_stacks(source)
+            if folded:
+                path = os.path.join(directory, f"{source}-{suffix}.folded")
+                with open(path, 'w') as output:
+                    output.write(folded + '\n')
+                paths.append(path)
+        
+        for path in paths:
+            print(f"Wrote profiling report {path}")
+        return paths
@@ -0,0 +1,100 @@
+from db_connector import DatabaseConnector
+from producer import SalesProducer
+from config import RECONCILE_LEAF_SIZE, RECONCILE_FANOUT, RECONCILE_FETCH_SIZE
+
+
+class SalesReconciler:
+    def __init__(self, branch_name):
+        """
+        Detect and repair drift between a branch and the head office.
+        Both sides digest their sales per sale_id block (row count and XOR of
+        per-row content hashes). Matching blocks are skipped, mismatched blocks
+        are split further, and only the rows in mismatched leaf blocks are
+        compared and re-sent as upsert or delete events.
+        :param branch_name: 'branch1' or 'branch2'
+        """
+        self.branch_name = branch_name
+        self.branch_db = DatabaseConnector(branch_name)
+        self.head_office_db = DatabaseConnector('head_office')
+        self.producer = SalesProducer(branch_name)
+    
+    def reconcile(self):
+        """
+        Re-send the sales that differ between the branch and the head office
+        :return: Dictionary with the number of upserts and deletes sent
+        """
+        result = {'upserts': 0, 'deletes': 0}
+        
+        self.branch_db.connect()
+        self.head_office_db.connect()
+        
+        try:
+            branch_max = self.branch_db.get_max_sale_id()
+            head_office_max = self.head_office_db.get_max_sale_id(self.branch_name)
+            high = max(branch_max or 0, head_office_max or 0)
+            
+            if not high:
+                print(f"No sales to reconcile for {self.branch_name}")
+                return result
+            
+            # Start with at most RECONCILE_FANOUT blocks covering the whole id range
+            block_size = RECONCILE_LEAF_SIZE
+            while high // block_size + 1 > RECONCILE_FANOUT:
+                block_size *= RECONCILE_FANOUT
+            
+            upserts, deletes = [], []
+            self._compare_range(0, high, block_size, upserts, deletes)
+            
+            # Re-send the drifted rows
+            for start in range(0, len(upserts), RECONCILE_FETCH_SIZE):
+                sales = self.branch_db.get_sales_by_ids(upserts[start:start + RECONCILE_FETCH_SIZE]) or []
+                for sale in sales:
+                    if self.producer.send_sale_data(sale, event='upsert', lane='bulk'):
+                        result['upserts'] += 1
+            
+            for sale_id in deletes:
+                if self.producer.send_delete_event(sale_id):
+                    result['deletes'] += 1
+        finally:
+            self.producer.close_connection()
+            self.branch_db.disconnect()
+            self.head_office_db.disconnect()
+        
+        print(f"Reconciled {self.branch_name}: {result['upserts']} upserts, {result['deletes']} deletes")
+        return result
+    
+    def _compare_range(self, low, high, block_size, upserts, deletes):
+        """Descend into the blocks of [low, high] whose digests differ"""
+        branch_digests = self.branch_db.get_range_digests(low, high, block_size)
+        head_office_digests = self.head_office_db.get_range_digests(low, high, block_size, self.branch_name)
+        
+        if branch_digests is None or head_office_digests is None:
+            raise RuntimeError(f"Failed to read range digests for {self.branch_name}")
+        
+        for block in sorted(set(branch_digests) | set(head_office_digests)):
+            if branch_digests.get(block) == head_office_digests.get(block):
+                continue
+            
+            block_low = max(low, block * block_size)
+            block_high = min(high, (block + 1) * block_size - 1)
+            
+            if block_size <= RECONCILE_LEAF_SIZE:
+                self._compare_rows(block_low, block_high, upserts, deletes)
+            else:
+                self._compare_range(block_low, block_high, block_size // RECONCILE_FANOUT, upserts, deletes)
+    
+    def _compare_rows(self, low, high, upserts, deletes):
+        """Compare the row hashes of a leaf block"""
+        branch_hashes = self.branch_db.get_row_hashes(low, high)
+        head_office_hashes = self.head_office_db.get_row_hashes(low, high, self.branch_name)
+        
+        if branch_hashes is None or head_office_hashes is None:
+            raise RuntimeError(f"Failed to read row hashes for {self.branch_name}")
+        
+        for sale_id, row_hash in branch_hashes.items():
+            if head_office_hashes.get(sale_id) != row_hash:
+                upserts.append(sale_id)
+        
+        for sale_id in head_office_hashes:
+            if sale_id not in branch_hashes:
+                deletes.append(sale_id)
@@ -0,0 +1,193 @@
+import json
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+from sale_record import SaleRecord, MONEY_LIMIT, MAX_QTY, MAX_REGION_LENGTH, MAX_PRODUCT_LENGTH
+
+# A decoded message: sale is None for delete events
+DecodedSale = namedtuple('DecodedSale', ['event', 'branch', 'sale_id', 'sale'])
+
+EVENTS = ('insert', 'upsert', 'delete')
+DATE_CACHE_SIZE = 4096
+
+
+class SaleDecodeError(ValueError):
+    """Raised when a message does not match the sale wire schema"""
+
+
+class SaleDecoder:
+    def __init__(self, date_cache_size=DATE_CACHE_SIZE):
+        """
+        Decoder for the sale wire schema produced by SaleRecord.to_message
+        Money fields are decoded to exact Decimals straight from the JSON text,
+        and dates are parsed once per distinct value thanks to a small memo cache.
+        Every field is checked against the head office columns, so a message the
+        database would reject is dropped instead of being requeued forever.
+        :param date_cache_size: Maximum number of distinct dates kept in the cache
+        """
+        self.date_cache = {}
+        self.date_cache_size = date_cache_size
+        
+        # Reusing one JSON decoder avoids building a new one per json.loads call
+        self.json_decoder = json.JSONDecoder(parse_float=Decimal)
+    
+    def parse_date(self, value):
+        """Parse a YYYY-MM-DD date, falling back to full ISO timestamps"""
+        if not isinstance(value, str):
+            raise SaleDecodeError(f"Invalid date: {value!r}")
+        
+        parsed = self.date_cache.get(value)
+        if parsed is not None:
+            return parsed
+        
+        try:
+            if len(value) == 10:
+                parsed = date.fromisoformat(value)
+            else:
+                # Timestamps, optionally with a trailing Z
+                parsed = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value).date()
+        except ValueError:
+            raise SaleDecodeError(f"Invalid date: {value!r}")
+        
+        # Sales cluster on a few dates, so the cache rarely fills up
+        if len(self.date_cache) < self.date_cache_size:
+            self.date_cache[value] = parsed
+        return parsed
+    
+    def parse_money(self, value, field):
+        """Convert a money field to an exact Decimal that fits DECIMAL(10, 2)"""
+        value_type = type(value)
+        if value_type is Decimal or value_type is int or value_type is str:
+            try:
+                money = Decimal(value)
+                # NaN fails the comparison with InvalidOperation, infinities are out of range
+                if -MONEY_LIMIT < money < MONEY_LIMIT:
+                    return money
+            except ArithmeticError:
+                pass
+        raise SaleDecodeError(f"Invalid {field}: {value!r}")
+    
+    def decode(self, body):
+        """
+        Decode and validate one message body
+        :param body: Raw message body (bytes or str)
+        :return: DecodedSale
+        """
+        try:
+            if isinstance(body, (bytes, bytearray)):
+                body = body.decode('utf-8')
+            message = self.json_decoder.decode(body)
+        except ValueError as e:
+            raise SaleDecodeError(f"Invalid JSON: {e}")
+        
+        if not isinstance(message, dict):
+            raise SaleDecodeError("Message is not an object")
+        
+        event = message.get('event', 'insert')
+        branch = message.get('branch')
+        sale_id = message.get('sale_id')
+        
+        if event not in EVENTS:
+            raise SaleDecodeError(f"Unknown event: {event!r}")
+        if type(branch) is not str:
+            raise SaleDecodeError(f"Invalid branch: {branch!r}")
+        if type(sale_id) is not int:
+            raise SaleDecodeError(f"Invalid sale_id: {sale_id!r}")
+        
+        if event == 'delete':
+            return DecodedSale(event, branch, sale_id, None)
+        
+        try:
+            raw_date = message['date']
+            region = message['region']
+            product = message['product']
+            qty = message['qty']
+            cost = message['cost']
+            amt = message['amt']
+            tax = message['tax']
+            total = message['total']
+        except KeyError as e:
+            raise SaleDecodeError(f"Missing field: {e}")
+        
+        sale_date = self.date_cache.get(raw_date) if type(raw_date) is str else None
+        if sale_date is None:
+            sale_date = self.parse_date(raw_date)
+        
+        if type(region) is not str or not 0 < len(region) <= MAX_REGION_LENGTH:
+            raise SaleDecodeError(f"Invalid region: {region!r}")
+        if type(product) is not str or not 0 < len(product) <= MAX_PRODUCT_LENGTH:
+            raise SaleDecodeError(f"Invalid product: {product!r}")
+        if type(qty) is not int or not -MAX_QTY <= qty <= MAX_QTY:
+            raise SaleDecodeError(f"Invalid qty: {qty!r}")
+        
+        # JSON numbers with a fraction arrive as finite Decimals, only the range is left to check
+        return DecodedSale(event, branch, sale_id, SaleRecord(
+            sale_id,
+            sale_date,
+            region,
+            product,
+            qty,
+            cost if type(cost) is Decimal and -MONEY_LIMIT < cost < MONEY_LIMIT else self.parse_money(cost, 'cost'),
+            amt if type(amt) is Decimal and -MONEY_LIMIT < amt < MONEY_LIMIT else self.parse_money(amt, 'amt'),
+            tax if type(tax) is Decimal and -MONEY_LIMIT < tax < MONEY_LIMIT else self.parse_money(tax, 'tax'),
+            total if type(total) is Decimal and -MONEY_LIMIT < total < MONEY_LIMIT else self.parse_money(total, 'total')
+        ))
+
+
+def run_benchmark(count=200000):
+    """Compare the decoder with the previous exception-driven parsing"""
+    # A price list of 20 products and quantities up to 100, so money values repeat
+    # about as much as in real sales rather than being a single cached value
+    prices = [Decimal(f'{5 + index * 3.17:.2f}') for index in range(20)]
+    bodies = []
+    for sale_id in range(count):
+        qty = 1 + sale_id * 7 % 100
+        cost = prices[sale_id % len(prices)]
+        amt = cost * qty
+        tax = (amt * Decimal('0.12')).quantize(Decimal('0.01'))
+        sale = SaleRecord(sale_id, date(2025, 3, 1 + sale_id % 28), 'East', 'Paper', qty,
+                          cost, amt, tax, amt + tax)
+        bodies.append(json.dumps(sale.to_message('branch1')).encode())
+    
+    def legacy_decode(body):
+        # Previous consumer path: exception-driven date fallbacks and float money fields
+        message = json.loads(body)
+        try:
+            sale_date = datetime.fromisoformat(message['date']).date()
+        except ValueError:
+            sale_date = datetime.strptime(message['date'], "%Y-%m-%d").date()
+        return SaleRecord(
+            message['sale_id'], sale_date, message['region'], message['product'], message['qty'],
+            message['cost'], message['amt'], message['tax'], message['total']
+        )
+    
+    decoder = SaleDecoder()
+    
+    # Validate against the encoder before timing
+    for body in bodies[:1000]:
+        decoded = decoder.decode(body)
+        legacy = legacy_decode(body)
+        assert decoded.sale.date == legacy.date
+        assert decoded.sale.total == Decimal(str(legacy.total))
+    
+    # Same loop for both paths, alternating runs and keeping the best of each,
+    # so machine noise and garbage collection hit both alike
+    legacy_time = decoder_time = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for body in bodies:
+            legacy_decode(body)
+        legacy_time = min(legacy_time, time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        for body in bodies:
+            decoder.decode(body)
+        decoder_time = min(decoder_time, time.perf_counter() - start)
+    
+    print(f"Previous parsing (float money): {count / legacy_time:,.0f} messages/s")
+    print(f"SaleDecoder (Decimal money):    {count / decoder_time:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    run_benchmark()
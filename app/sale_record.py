@@ -0,0 +1,115 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+# Column limits of product_sales
+MAX_MONEY = Decimal('99999999.99')  # DECIMAL(10, 2)
+MONEY_LIMIT = MAX_MONEY + Decimal('0.005')  # Values are rounded to cents, from here up they overflow
+MAX_QTY = 2 ** 31 - 1  # INT
+MAX_REGION_LENGTH = 50
+MAX_PRODUCT_LENGTH = 100
+
+
+def check_money(value, field):
+    """
+    Check that a Decimal money value can be stored in a DECIMAL(10, 2) column
+    :param field: Field name, used in error messages
+    :return: The value
+    :raises ValueError: If the value is not finite or out of range
+    """
+    if not value.is_finite() or abs(value) >= MONEY_LIMIT:
+        raise ValueError(f"{field} {value} does not fit DECIMAL(10, 2)")
+    return value
+
+
+def check_text(value, field, max_length):
+    """
+    Check that a text value fits its VARCHAR column
+    :return: The value
+    :raises ValueError: If the value is not a non-empty string of at most max_length characters
+    """
+    if type(value) is not str or not value or len(value) > max_length:
+        raise ValueError(f"{field} must be a string of 1 to {max_length} characters, got {value!r}")
+    return value
+
+
+class SaleRecord:
+    """
+    Compact sale representation shared by the branch reader, the producer and the consumer.
+    Uses __slots__ so large batches do not carry a dictionary per row, and converts
+    directly to the tuples used as DB params and to the wire message.
+    """
+    __slots__ = ('sale_id', 'date', 'region', 'product', 'qty', 'cost', 'amt', 'tax', 'total')
+    
+    # Column order expected by from_row
+    COLUMNS = 'sale_id, date, region, product, qty, cost, amt, tax, total'
+    
+    def __init__(self, sale_id, date, region, product, qty, cost, amt, tax, total):
+        self.sale_id = sale_id
+        self.date = date
+        self.region = region
+        self.product = product
+        self.qty = qty
+        self.cost = cost
+        self.amt = amt
+        self.tax = tax
+        self.total = total
+    
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from a tuple in COLUMNS order"""
+        return cls(*row)
+    
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from a dictionary, sale_id is optional for new sales"""
+        return cls(
+            data.get('sale_id'),
+            data['date'],
+            data['region'],
+            data['product'],
+            data['qty'],
+            data['cost'],
+            data['amt'],
+            data['tax'],
+            data['total']
+        )
+    
+    @classmethod
+    def coerce(cls, sale):
+        """Accept either a SaleRecord or a sale dictionary"""
+        return sale if isinstance(sale, cls) else cls.from_dict(sale)
+    
+    def to_branch_params(self):
+        """Params for inserting the sale into a branch (sale_id is generated)"""
+        return (self.date, self.region, self.product, self.qty, self.cost, self.amt, self.tax, self.total)
+    
+    def to_head_office_params(self, source_branch):
+        """Params for inserting the sale into the head office"""
+        return (
+            self.sale_id, source_branch, self.date, self.region, self.product,
+            self.qty, self.cost, self.amt, self.tax, self.total
+        )
+    
+    def to_message(self, branch_name, event='insert'):
+        """Build the wire message published to RabbitMQ"""
+        sale_date = self.date
+        return {
+            'sale_id': self.sale_id,
+            'date': sale_date.isoformat() if isinstance(sale_date, (datetime, date)) else sale_date,
+            'region': self.region,
+            'product': self.product,
+            'qty': self.qty,
+            'cost': float(self.cost),
+            'amt': float(self.amt),
+            'tax': float(self.tax),
+            'total': float(self.total),
+            'branch': branch_name,
+            'event': event,
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def __repr__(self):
+        return (
+            f"SaleRecord(sale_id={self.sale_id!r}, date={self.date!r}, region={self.region!r}, "
+            f"product={self.product!r}, qty={self.qty!r}, total={self.total!r})"
+        )
@@ -0,0 +1,191 @@
+import os
+import mmap
+import fcntl
+import struct
+import threading
+
+# Header: magic, read offset, write offset. Records: 4-byte length + payload.
+HEADER = struct.Struct('<8sQQ')
+MAGIC = b'SPILL002'
+LENGTH = struct.Struct('<I')
+
+# Length value marking that the next record starts at the front of the file
+WRAP = 0xFFFFFFFF
+
+
+class SpillJournal:
+    """
+    Bounded FIFO of pending messages in a memory-mapped ring buffer.
+    Records are appended at the write offset and consumed from the read offset,
+    wrapping around to the front of the file when the end is reached. Both offsets
+    live in the file header, so a journal left behind by a stopped process is
+    drained by the next process that opens it.
+    The file is locked while open, a journal has a single owner process.
+    """
+    
+    def __init__(self, path, capacity, sync=False):
+        """
+        Open (or create) a journal
+        :param path: Journal file path
+        :param capacity: File size in bytes, the journal refuses records once full
+        :param sync: Flush every appended record to disk instead of leaving it to the OS
+        :raises BlockingIOError: If another process holds the journal
+        """
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            
+            size = os.fstat(self.fd).st_size
+            if size < capacity:
+                os.ftruncate(self.fd, capacity)
+                size = capacity
+            
+            self.map = mmap.mmap(self.fd, size)
+        except OSError:
+            os.close(self.fd)
+            raise
+        
+        self.size = size
+        magic, self.read_offset, self.write_offset = HEADER.unpack_from(self.map, 0)
+        
+        valid = HEADER.size <= self.read_offset <= size and HEADER.size <= self.write_offset <= size
+        if magic != MAGIC or not valid or self.read_offset == self.write_offset:
+            self._reset()
+        
+        self.count = self._count_records()
+        if self.count:
+            print(f"Recovered {self.count} spilled messages from {path}")
+    
+    @classmethod
+    def open_slot(cls, directory, name, capacity, slots, sync=False):
+        """
+        Open the first journal slot not held by another process
+        :return: SpillJournal, or None if every slot is taken
+        """
+        for slot in range(slots):
+            try:
+                return cls(os.path.join(directory, f"{name}-{slot}.journal"), capacity, sync)
+            except BlockingIOError:
+                continue
+        return None
+    
+    def _reset(self):
+        self.read_offset = self.write_offset = HEADER.size
+        self._write_header()
+    
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.read_offset, self.write_offset)
+    
+    def _next_record(self, offset):
+        """
+        Locate the record at an offset, following a wrap to the front of the file
+        :return: (record start offset, payload length)
+        """
+        if self.size - offset < LENGTH.size or LENGTH.unpack_from(self.map, offset)[0] == WRAP:
+            offset = HEADER.size
+        return offset, LENGTH.unpack_from(self.map, offset)[0]
+    
+    def _count_records(self):
+        count = 0
+        offset = self.read_offset
+        while offset != self.write_offset:
+            offset, length = self._next_record(offset)
+            offset += LENGTH.size + length
+            count += 1
+        return count
+    
+    def append(self, payload):
+        """
+        Append a record
+        :param payload: Record bytes
+        :return: False if the journal is full
+        """
+        needed = LENGTH.size + len(payload)
+        
+        with self.lock:
+            offset = self.write_offset
+            
+            # The write offset never catches up with the read offset, equal offsets mean empty
+            if offset >= self.read_offset:
+                if offset + needed > self.size:
+                    if HEADER.size + needed >= self.read_offset:
+                        return False
+                    
+                    # Wrap to the front, marking the rest of the file unless it is too short
+                    if self.size - offset >= LENGTH.size:
+                        LENGTH.pack_into(self.map, offset, WRAP)
+                    offset = HEADER.size
+            elif offset + needed >= self.read_offset:
+                return False
+            
+            LENGTH.pack_into(self.map, offset, len(payload))
+            self.map[offset + LENGTH.size:offset + needed] = payload
+            
+            # The header is updated last, a torn append is simply not visible
+            self.write_offset = offset + needed
+            self._write_header()
+            self.count += 1
+            
+            if self.sync:
+                self.map.flush()
+        
+        return True
+    
+    def drain(self, publish):
+        """
+        Hand records to a publish function in order, dropping each one it accepts.
+        The journal lock is not held while publishing, so appends are never stuck
+        behind a slow broker. Only one drain runs at a time, a second caller returns
+        at once and keeps spilling behind the running drain.
+        :param publish: Called with the record bytes, returns False to stop draining
+        :return: Number of records drained
+        """
+        drained = 0
+        
+        if not self.drain_lock.acquire(blocking=False):
+            return drained
+        
+        try:
+            while True:
+                with self.lock:
+                    if self.read_offset == self.write_offset:
+                        break
+                    offset, length = self._next_record(self.read_offset)
+                    start = offset + LENGTH.size
+                    payload = self.map[start:start + length]
+                
+                if not publish(payload):
+                    break
+                
+                # Only the drain moves the read offset, so the record is still the oldest
+                with self.lock:
+                    self.read_offset = start + length
+                    if self.read_offset == self.write_offset:
+                        self._reset()
+                    else:
+                        self._write_header()
+                    self.count -= 1
+                    drained += 1
+            
+            with self.lock:
+                self.map.flush()
+        finally:
+            self.drain_lock.release()
+        
+        return drained
+    
+    def close(self):
+        """Flush and close the journal, releasing it for other processes"""
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            os.close(self.fd)
@@ -0,0 +1,120 @@
+import threading
+from datetime import datetime
+from config import SYNC_INTERVAL, SYNC_MIN_INTERVAL, SYNC_MAX_INTERVAL
+
+
+class SyncJob:
+    def __init__(self, branch_name, interval):
+        """
+        Scheduling state of one branch
+        :param branch_name: 'branch1' or 'branch2'
+        :param interval: Starting interval in seconds
+        """
+        self.branch_name = branch_name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.last_run = None
+        self.last_changes = 0
+
+
+class SyncScheduler:
+    def __init__(self, sync_function, branches, interval=SYNC_INTERVAL,
+                 min_interval=SYNC_MIN_INTERVAL, max_interval=SYNC_MAX_INTERVAL):
+        """
+        Per-branch sync scheduler.
+        Each branch runs on its own thread with at most one sync in flight. The
+        interval halves after a run that found changes and doubles after an idle
+        run, within [min_interval, max_interval].
+        :param sync_function: Callable taking a branch name and returning the number of changes synced
+        :param branches: Branch names to schedule
+        """
+        self.sync_function = sync_function
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jobs = {branch: SyncJob(branch, interval) for branch in branches}
+        self.is_running = False
+        self.stop_event = None
+    
+    def start(self):
+        """Start one scheduling thread per branch"""
+        if self.is_running:
+            return False
+        
+        self.is_running = True
+        
+        # Each start gets its own stop event, so a loop left over from a previous
+        # start (still inside a slow sync) exits instead of resuming
+        self.stop_event = threading.Event()
+        for job in self.jobs.values():
+            job.wakeup.clear()
+            job.thread = threading.Thread(target=self._run_job_loop, args=(job, self.stop_event))
+            job.thread.daemon = True
+            job.thread.start()
+        
+        return True
+    
+    def stop(self):
+        """Stop the scheduling threads, waiting briefly for in-flight syncs"""
+        self.is_running = False
+        if self.stop_event:
+            self.stop_event.set()
+        
+        for job in self.jobs.values():
+            job.wakeup.set()
+        
+        for job in self.jobs.values():
+            if job.thread and job.thread.is_alive():
+                job.thread.join(timeout=2)
+    
+    def trigger(self, branch_name):
+        """Run a branch's sync as soon as possible instead of waiting for its interval"""
+        self.jobs[branch_name].wakeup.set()
+    
+    def run_exclusive(self, branch_name, function):
+        """
+        Run a function while holding a branch's sync slot
+        :return: The function's result, or None if a sync is already in flight
+        """
+        job = self.jobs[branch_name]
+        
+        if not job.lock.acquire(blocking=False):
+            return None
+        
+        try:
+            return function()
+        finally:
+            job.lock.release()
+    
+    def get_intervals(self):
+        """Get the current interval of each branch in seconds"""
+        return {branch: job.interval for branch, job in self.jobs.items()}
+    
+    def _run_job_loop(self, job, stop_event):
+        while not stop_event.is_set():
+            # Sleep until the interval elapses or a change is signalled
+            job.wakeup.wait(job.interval)
+            job.wakeup.clear()
+            
+            if stop_event.is_set():
+                break
+            
+            with job.lock:
+                print(f"Running scheduled sync of {job.branch_name} at {datetime.now()}")
+                try:
+                    changes = self.sync_function(job.branch_name)
+                except Exception as e:
+                    print(f"Scheduled sync of {job.branch_name} failed: {e}")
+                    changes = 0
+            
+            job.last_run = datetime.now()
+            job.last_changes = changes
+            
+            # Poll busy branches more often and back off idle ones
+            if changes:
+                job.interval = max(self.min_interval, job.interval / 2)
+            else:
+                job.interval = min(self.max_interval, job.interval * 2)
+            
+            print(f"Next sync of {job.branch_name} in {job.interval:.0f} seconds")
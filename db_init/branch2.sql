@@ -2,6 +2,7 @@
 -- Minimal schema for Branch Office Two database
 
 -- Drop table if it exists to ensure clean initialization
+DROP TABLE IF EXISTS sales_outbox;
 DROP TABLE IF EXISTS product_sales;
 
 -- Create product_sales table
@@ -17,6 +18,15 @@ CREATE TABLE product_sales (
     total DECIMAL(10, 2) NOT NULL
 );
 
+-- Create sales_outbox table (written in the same transaction as new sales)
+CREATE TABLE sales_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    sale_id INT NOT NULL,  -- The sale to publish
+    lane VARCHAR(16) NOT NULL DEFAULT 'realtime',  -- 'realtime' or 'bulk'
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_lane (lane, id)
+);
+
 -- Insert sample sales data for Branch 2
 INSERT INTO product_sales (date, region, product, qty, cost, amt, tax, total) VALUES
 ('2025-03-01', 'West', 'Paper', 33, 12.05, 427.35, 29.91, 457.26),
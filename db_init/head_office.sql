@@ -15,7 +15,8 @@ CREATE TABLE product_sales (
     tax DECIMAL(10, 2) NOT NULL,
     total DECIMAL(10, 2) NOT NULL,
     last_sync TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    UNIQUE KEY (original_sale_id, source_branch)  -- Prevent duplicate sales from the same branch
+    UNIQUE KEY (original_sale_id, source_branch),  -- Prevent duplicate sales from the same branch
+    KEY idx_branch_sale (source_branch, original_sale_id)  -- Per-branch range scans (reconciliation, high-water marks)
 );
 
 -- Create a view for easy reporting